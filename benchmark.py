@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import struct
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+import fake_hitomi
+import hitomiv2
+
+
+def timeit(func: Callable, repeat: int = 5) -> float:
+    """返回多次运行中的最短耗时 (秒)"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name: str, before: float, after: float):
+    print(f'{name:<32} 旧: {before * 1000:10.2f} ms  新: {after * 1000:10.2f} ms  加速: {before / after:8.1f}x')
+
+
+# ================= ID 解码与集合运算 =================
+
+def legacy_decode_nozomi(data: bytes) -> set[int]:
+    """2.0 版本逐个 struct.unpack 的解码方式, 仅作对照"""
+    total_ids = len(data) // 4
+    ids = set()
+    for i in range(total_ids):
+        gid = struct.unpack('>i', data[i * 4: (i + 1) * 4])[0]
+        ids.add(gid)
+    return ids
+
+
+def make_nozomi(count: int, seed: int = 0) -> bytes:
+    """生成按新到旧排列的 nozomi 数据"""
+    rng = random.Random(seed)
+    ids = sorted(rng.sample(range(1, count * 3), count), reverse=True)
+    return np.asarray(ids, dtype='>i4').tobytes()
+
+
+def benchDecode(count: int):
+    big = make_nozomi(count, seed=1)
+    small = make_nozomi(max(count // 100, 1), seed=2)
+    print(f'nozomi 负载: {count} 个 ID ({len(big) / 1024 ** 2:.1f} MiB)')
+    report('解码',
+           timeit(lambda: legacy_decode_nozomi(big), repeat=1),
+           timeit(lambda: hitomiv2.decode_ids(big)))
+    big_set, small_set = legacy_decode_nozomi(big), legacy_decode_nozomi(small)
+    big_arr, small_arr = hitomiv2.decode_ids(big), hitomiv2.decode_ids(small)
+    report('交集',
+           timeit(lambda: big_set.intersection(small_set)),
+           timeit(lambda: hitomiv2.intersect_ids(big_arr, small_arr)))
+    report('差集',
+           timeit(lambda: big_set.difference(small_set)),
+           timeit(lambda: hitomiv2.difference_ids(big_arr, small_arr)))
+    report('排序输出',
+           timeit(lambda: sorted(list(big_set), reverse=True)),
+           timeit(lambda: big_arr[::-1].tolist()))
+    print(f'内存 (容器本体): 旧 set ≈ {big_set.__sizeof__() / 1024 ** 2:.1f} MiB (另含每个 int 对象), '
+          f'新 ndarray = {big_arr.nbytes / 1024 ** 2:.1f} MiB')
+
+
+# ================= 画廊元数据解析 =================
+
+def legacy_parse_gallery(raw: bytes) -> hitomiv2.Comic:
+    """2.0 版本 文本解码 -> 正则 -> json.loads -> model_validate 的解析方式, 仅作对照"""
+    text = raw.decode('utf-8')
+    match = re.search(r'{.*', text, re.DOTALL)
+    return hitomiv2.Comic.model_validate(json.loads(match.group(0)))
+
+
+def make_gallery(gallery_id: int, pages: int, rng: random.Random) -> bytes:
+    """生成结构与真实 galleries/{id}.js 一致的画廊数据"""
+    info = {
+        'id': gallery_id, 'title': f'title {gallery_id}', 'japanese_title': None, 'type': 'doujinshi',
+        'language': 'chinese', 'language_localname': '中文', 'date': '2024-01-01 00:00:00-05',
+        'datepublished': None, 'galleryurl': f'/doujinshi/title-{gallery_id}.html', 'blocked': 0,
+        'video': None, 'videofilename': None, 'related': [gallery_id - 1, gallery_id + 1],
+        'scene_indexes': [], 'characters': None, 'groups': None,
+        'parodys': [{'parody': 'original', 'url': '/series/original-all.html'}],
+        'artists': [{'artist': f'artist{rng.randint(1, 999)}', 'url': '/artist/x-all.html'}],
+        'languages': [{'name': 'japanese', 'galleryid': gallery_id - 1, 'language_localname': '日本語',
+                       'url': f'/galleries/{gallery_id - 1}.html'}],
+        'tags': [{'tag': f'tag{rng.randint(1, 500)}', 'url': '/tag/x-all.html',
+                  'female': rng.choice([1, '1', '', None]), 'male': rng.choice([1, '']) or ''}
+                 for _ in range(rng.randint(5, 40))],
+        'files': [{'hasavif': 1, 'hash': f'{rng.getrandbits(256):064x}', 'height': 1600, 'width': 1131,
+                   'name': f'{i:03d}.jpg'} for i in range(pages)],
+    }
+    info['tags'] = [{k: v for k, v in tag.items() if v is not None} for tag in info['tags']]
+    return ('var galleryinfo = ' + json.dumps(info, ensure_ascii=False)).encode('utf-8')
+
+
+def loadGalleries(fixtures: Optional[Path], count: int) -> list[bytes]:
+    if fixtures is not None:
+        return [path.read_bytes() for path in sorted(fixtures.glob('*.js'))]
+    rng = random.Random(0)
+    return [make_gallery(1000000 + i, rng.randint(10, 300), rng) for i in range(count)]
+
+
+def benchParse(fixtures: Optional[Path], count: int):
+    corpus = loadGalleries(fixtures, count)
+    total = sum(len(raw) for raw in corpus)
+    print(f'画廊样本: {len(corpus)} 个 ({total / 1024 ** 2:.1f} MiB)' + (f' 来自 {fixtures}' if fixtures else ' (合成)'))
+    for raw in corpus:
+        if legacy_parse_gallery(raw) != hitomiv2.parseGalleryInfo(raw):
+            raise AssertionError('新旧解析结果不一致')
+    before = timeit(lambda: [legacy_parse_gallery(raw) for raw in corpus], repeat=3)
+    after = timeit(lambda: [hitomiv2.parseGalleryInfo(raw) for raw in corpus], repeat=3)
+    report('解析全部样本', before, after)
+    print(f'平均每个画廊: 旧 {before / len(corpus) * 1e6:.0f} µs  新 {after / len(corpus) * 1e6:.0f} µs')
+
+
+def retained(build: Callable[[], list]) -> tuple[list, int]:
+    """构造对象并返回其常驻内存 (tracemalloc 统计的净增量, 字节)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return objects, size
+
+
+def benchSummary(fixtures: Optional[Path], count: int):
+    corpus = [hitomiv2.galleryinfo_json(raw) for raw in loadGalleries(fixtures, count)]
+    total = sum(len(data) for data in corpus)
+    print(f'画廊样本: {len(corpus)} 个 ({total / 1024 ** 2:.1f} MiB)' + (f' 来自 {fixtures}' if fixtures else ' (合成)'))
+    for data in corpus[:50]:
+        full, summary = hitomiv2.Comic.model_validate_json(data), hitomiv2.ComicSummary(data)
+        if summary.comic() != full or summary.tags != tuple(hitomiv2.tagTerm(tag) for tag in full.tags):
+            raise AssertionError('摘要与完整模型不一致')
+    report('解析全部样本',
+           timeit(lambda: [hitomiv2.Comic.model_validate_json(data) for data in corpus], repeat=3),
+           timeit(lambda: [hitomiv2.ComicSummary(data) for data in corpus], repeat=3))
+    comics, full_size = retained(lambda: [hitomiv2.Comic.model_validate_json(data) for data in corpus])
+    del comics
+    # ComicSummary 直接引用样本中的原始 JSON, 这部分不在 tracemalloc 增量里, 需另外加上
+    summaries, summary_size = retained(lambda: [hitomiv2.ComicSummary(data) for data in corpus])
+    summary_size += total
+    print(f'常驻内存: Comic {full_size / 1024 ** 2:.1f} MiB  '
+          f'ComicSummary {summary_size / 1024 ** 2:.1f} MiB (其中原始 JSON {total / 1024 ** 2:.1f} MiB)  '
+          f'节省: {full_size / summary_size:.1f}x')
+    start = time.perf_counter()
+    pages = sum(len(summary.files) for summary in summaries)
+    print(f'首次访问 files (延迟校验): {(time.perf_counter() - start) * 1000:.2f} ms, 共 {pages} 页')
+
+
+# ================= ZIP 打包 =================
+
+def make_pages(count: int, size: int, seed: int = 0) -> list[bytes]:
+    """生成部分可压缩的页面数据: 随机字节中夹杂重复片段, 压缩耗时与真实图片相近"""
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(count):
+        chunk = rng.randbytes(1024)
+        pages.append(b''.join(chunk if rng.random() < 0.3 else rng.randbytes(1024) for _ in range(size // 1024)))
+    return pages
+
+
+def serialZip(pages: list[bytes]) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for i, page in enumerate(pages):
+            hitomiv2.writeZipEntry(zipf, f'{i:04d}.webp', io.BytesIO(page))
+    return buf.getvalue()
+
+
+async def parallelZip(pages: list[bytes]) -> io.BytesIO:
+    # 返回 BytesIO 而不是 bytes: asyncio.run 收尾时可能对任务取 repr, 会把整个结果格式化一遍
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        writer = hitomiv2.ParallelZipWriter(zipf)
+        for i, page in enumerate(pages):
+            await writer.add(f'{i:04d}.webp', io.BytesIO(page))
+        await writer.finish()
+    return buf
+
+
+def benchZip(pages: int, page_size: int, workers: Optional[int]):
+    hitomiv2.setZipWorkers(workers)
+    corpus = make_pages(pages, page_size)
+    # 包含空条目与高度可压缩的条目, 覆盖 deflate 的边界情况
+    corpus += [b'', b'\0' * page_size]
+    print(f'页面: {len(corpus)} 个 ({sum(map(len, corpus)) / 1024 ** 2:.1f} MiB), '
+          f'压缩线程: {workers or os.cpu_count()}')
+    serial, parallel = serialZip(corpus), asyncio.run(parallelZip(corpus)).getvalue()
+    serial_hash, parallel_hash = hashlib.sha256(serial).hexdigest(), hashlib.sha256(parallel).hexdigest()
+    print(f'writeZipEntry     sha256: {serial_hash}')
+    print(f'ParallelZipWriter sha256: {parallel_hash}')
+    if serial_hash != parallel_hash:
+        raise AssertionError('并行打包结果与 writeZipEntry 不一致')
+    report('打包全部页面',
+           timeit(lambda: serialZip(corpus), repeat=3),
+           timeit(lambda: asyncio.run(parallelZip(corpus)), repeat=3))
+
+
+# ================= 端到端 (本地模拟服务器) =================
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def makeQueries(corpus: fake_hitomi.FakeCorpus) -> list[str]:
+    """覆盖单个 B 树词、多词求交、nozomi + B 树、OR 组与排除词的查询集合"""
+    return ['word0', 'word1 word2', 'word3 language:chinese', 'female:tag0 language:japanese',
+            'word5 language:chinese -type:manga', 'female:tag1 or male:tag1 word0',
+            f'artist:{corpus.galleries[corpus.gallery_ids[0]]["artists"][0]["artist"]}']
+
+
+async def benchSearch(galleries: int, latency: float, repeat: int):
+    corpus = fake_hitomi.FakeCorpus(galleries)
+    print(f'模拟服务器: {galleries} 个画廊, 每个请求延迟 {latency * 1000:.0f} ms')
+    async with fake_hitomi.FakeHitomiServer(corpus, latency=latency) as server:
+        async with server.session() as session:
+            await hitomiv2.refreshVersion(session)
+            for query in makeQueries(corpus):
+                cold = []
+                for _ in range(repeat):
+                    # 冷: 清空 B 树与搜索缓存, 连接池保持
+                    hitomiv2.setBTreeCache()
+                    hitomiv2.setSearchCache()
+                    server.resetStats()
+                    start = time.perf_counter()
+                    ids = await hitomiv2.searchIDs(query, session=session)
+                    cold.append(time.perf_counter() - start)
+                requests, transferred = server.stats['ltn_requests'], server.stats['bytes']
+                warm = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    await hitomiv2.searchIDs(query, session=session)
+                    warm.append(time.perf_counter() - start)
+                print(f'{query:<40} {len(ids):>6} 个结果  冷: p50 {percentile(cold, 0.5) * 1000:8.2f} ms '
+                      f'p95 {percentile(cold, 0.95) * 1000:8.2f} ms  {requests:>3} 个请求 {transferred / 1024:8.1f} KiB  '
+                      f'热: p50 {percentile(warm, 0.5) * 1000:6.3f} ms')
+
+
+async def downloadOnce(server: fake_hitomi.FakeHitomiServer, comic: hitomiv2.Comic,
+                       concurrency: int) -> tuple[float, int, bool]:
+    """下载一次画廊, 返回 (耗时, 归档大小, 是否成功)"""
+
+    # noinspection PyUnusedLocal
+    async def page_done(dl_url: str):
+        pass
+
+    async with server.session() as session:
+        with tempfile.TemporaryFile() as f:
+            start = time.perf_counter()
+            try:
+                ok = await hitomiv2.downloadComic(comic, f, max_threads=concurrency,
+                                                  phase_callback=page_done, session=session)
+            except ConnectionError:
+                ok = False
+            seconds = time.perf_counter() - start
+            return seconds, f.seek(0, 2), ok
+
+
+async def benchDownload(pages: int, page_size: int, latency: float, bandwidth: Optional[float],
+                        concurrency: int, repeat: int):
+    corpus = fake_hitomi.FakeCorpus(1, min_pages=pages, max_pages=pages, page_size=page_size)
+    limit = f'{bandwidth / 1024 ** 2:.1f} MiB/s' if bandwidth else '不限'
+    print(f'画廊: {pages} 页 x {page_size / 1024:.0f} KiB, 延迟 {latency * 1000:.0f} ms, 每连接带宽 {limit}, '
+          f'并发 {concurrency}')
+    async with fake_hitomi.FakeHitomiServer(corpus, latency=latency, bandwidth=bandwidth) as server:
+        async with server.session() as session:
+            comic = await hitomiv2.getComic(corpus.gallery_ids[0], session)
+        samples = []
+        for _ in range(repeat):
+            seconds, size, ok = await downloadOnce(server, comic, concurrency)
+            if not ok:
+                raise AssertionError('下载失败')
+            samples.append(seconds)
+        payload = pages * page_size
+        best = min(samples)
+        print(f'耗时: 最好 {best:.3f}s  中位 {statistics.median(samples):.3f}s  '
+              f'吞吐 {payload / 1024 ** 2 / best:.1f} MiB/s  {pages / best:.0f} 页/s  归档 {size / 1024 ** 2:.1f} MiB')
+        tracemalloc.start()
+        await downloadOnce(server, comic, concurrency)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'内存: Python 分配峰值 {peak / 1024 ** 2:.1f} MiB (负载 {payload / 1024 ** 2:.1f} MiB), '
+              f'进程 RSS 峰值 {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+
+
+async def benchRetry(pages: int, error_rate: float, throttle_rate: float, concurrency: int):
+    corpus = fake_hitomi.FakeCorpus(1, min_pages=pages, max_pages=pages, page_size=16 * 1024)
+    print(f'画廊: {pages} 页, 图片请求 {error_rate:.0%} 返回 503, {throttle_rate:.0%} 返回 429 (Retry-After: 0)')
+    async with fake_hitomi.FakeHitomiServer(corpus, error_rate=error_rate, throttle_rate=throttle_rate,
+                                            retry_after=0) as server:
+        async with server.session() as session:
+            comic = await hitomiv2.getComic(corpus.gallery_ids[0], session)
+        hitomiv2.host_health.clear()
+        server.resetStats()
+        seconds, _, ok = await downloadOnce(server, comic, concurrency)
+        stats = server.stats
+        print(f'{"成功" if ok else "失败"}, 耗时 {seconds:.2f}s, 图片请求 {stats["image_requests"]} 次 '
+              f'(放大 {stats["image_requests"] / pages:.2f}x), 注入 503: {stats["injected_503"]}, '
+              f'429: {stats["injected_429"]}')
+        for host, health in sorted(hitomiv2.host_health.items()):
+            print(f'  {host}: 并发窗口 {health.window:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hitomi 性能基准')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    decode_parser = sub.add_parser('decode', help='nozomi/data ID 解码与集合运算')
+    decode_parser.add_argument('-n', '--count', type=int, default=3_000_000, help='ID 数量')
+    parse_parser = sub.add_parser('parse', help='galleries/*.js 元数据解析')
+    parse_parser.add_argument('-f', '--fixtures', type=Path, help='保存的 galleries/*.js 目录, 默认使用合成样本')
+    parse_parser.add_argument('-n', '--count', type=int, default=500, help='合成样本数量')
+    summary_parser = sub.add_parser('summary', help='Comic 与 ComicSummary 的解析耗时与常驻内存')
+    summary_parser.add_argument('-f', '--fixtures', type=Path, help='保存的 galleries/*.js 目录, 默认使用合成样本')
+    summary_parser.add_argument('-n', '--count', type=int, default=5000, help='合成样本数量')
+    zip_parser = sub.add_parser('zip', help='ParallelZipWriter 与 writeZipEntry 的打包耗时及哈希一致性')
+    zip_parser.add_argument('-p', '--pages', type=int, default=120, help='页面数')
+    zip_parser.add_argument('-s', '--page-size', type=int, default=512 * 1024, help='每页字节数')
+    zip_parser.add_argument('-w', '--workers', type=int, help='压缩线程数, 默认为 CPU 核数')
+    search_parser = sub.add_parser('search', help='本地模拟服务器上的 searchIDs 延迟 (冷 / 热缓存)')
+    search_parser.add_argument('-g', '--galleries', type=int, default=20000, help='模拟的画廊数量')
+    search_parser.add_argument('-l', '--latency', type=float, default=0.02, help='每个请求的延迟 (秒)')
+    search_parser.add_argument('-r', '--repeat', type=int, default=5, help='每个查询的重复次数')
+    download_parser = sub.add_parser('download', help='本地模拟服务器上的 downloadComic 吞吐与内存')
+    download_parser.add_argument('-p', '--pages', type=int, default=60, help='画廊页数')
+    download_parser.add_argument('-s', '--page-size', type=int, default=256 * 1024, help='每页字节数')
+    download_parser.add_argument('-l', '--latency', type=float, default=0.02, help='每个请求的延迟 (秒)')
+    download_parser.add_argument('-b', '--bandwidth', type=float, help='每个连接的带宽 (字节/秒), 默认不限')
+    download_parser.add_argument('-c', '--concurrency', type=int, default=5, help='页面并发数')
+    download_parser.add_argument('-r', '--repeat', type=int, default=3, help='重复次数')
+    retry_parser = sub.add_parser('retry', help='注入 503 / 429 时的重试行为')
+    retry_parser.add_argument('-p', '--pages', type=int, default=40, help='画廊页数')
+    retry_parser.add_argument('-e', '--error-rate', type=float, default=0.1, help='返回 503 的比例')
+    retry_parser.add_argument('-t', '--throttle-rate', type=float, default=0.05, help='返回 429 的比例')
+    retry_parser.add_argument('-c', '--concurrency', type=int, default=5, help='页面并发数')
+    args = parser.parse_args()
+    if args.bench == 'decode':
+        benchDecode(args.count)
+    elif args.bench == 'parse':
+        benchParse(args.fixtures, args.count)
+    elif args.bench == 'summary':
+        benchSummary(args.fixtures, args.count)
+    elif args.bench == 'zip':
+        benchZip(args.pages, args.page_size, args.workers)
+    elif args.bench == 'search':
+        asyncio.run(benchSearch(args.galleries, args.latency, args.repeat))
+    elif args.bench == 'download':
+        asyncio.run(benchDownload(args.pages, args.page_size, args.latency, args.bandwidth,
+                                  args.concurrency, args.repeat))
+    elif args.bench == 'retry':
+        asyncio.run(benchRetry(args.pages, args.error_rate, args.throttle_rate, args.concurrency))
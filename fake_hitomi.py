@@ -0,0 +1,338 @@
+import asyncio
+import hashlib
+import http
+import json
+import random
+import re
+import struct
+import urllib.parse
+from collections import Counter
+from typing import Optional
+
+import httpx
+import numpy as np
+
+import hitomiv2
+
+IMAGE_DOMAIN = 'gold-usergeneratedcontent.net'
+
+
+# ================= 合成数据 =================
+
+def build_index(postings: dict[str, np.ndarray]) -> tuple[bytes, bytes]:
+    """
+    按 Hitomi 的格式生成 galleries.{version}.index 与 .data
+    .data 中每条记录为 [count, id1, id2, ...] (大端 int32, 新到旧), .index 为以 hash_term 为键的 B 树, 根节点位于地址 0
+    """
+    data = bytearray()
+    items = []
+    for term, ids in postings.items():
+        ids = np.sort(np.asarray(ids, dtype=np.int64))[::-1]
+        record = struct.pack('>i', ids.size) + ids.astype('>i4').tobytes()
+        items.append((hitomiv2.hash_term(term), (len(data), len(record))))
+        data += record
+    items.sort()
+
+    def build(node_items: list) -> dict:
+        if len(node_items) <= hitomiv2.B:
+            return {'items': node_items, 'children': []}
+        # 子树数量: 让每个子树尽量装满, 至多 B + 1 个
+        count = min(hitomiv2.B + 1, -(-(len(node_items) + 1) // (hitomiv2.B + 1)))
+        size = (len(node_items) - (count - 1)) / count
+        separators, children = [], []
+        start = 0
+        for i in range(count):
+            end = start + int(round(size * (i + 1))) - int(round(size * i))
+            children.append(build(node_items[start:end]))
+            if i < count - 1:
+                separators.append(node_items[end])
+            start = end + 1
+        return {'items': separators, 'children': children}
+
+    def node_size(node: dict) -> int:
+        return 4 + len(node['items']) * 8 + 4 + len(node['items']) * 12 + (hitomiv2.B + 1) * 8
+
+    order = []
+
+    def assign(node: dict, addr: int) -> int:
+        node['addr'] = addr
+        order.append(node)
+        addr += node_size(node)
+        for child in node['children']:
+            addr = assign(child, addr)
+        return addr
+
+    assign(build(items), 0)
+    index = bytearray()
+    for node in order:
+        index += struct.pack('>i', len(node['items']))
+        for key, _ in node['items']:
+            index += struct.pack('>i', len(key)) + key
+        index += struct.pack('>i', len(node['items']))
+        for _, (offset, length) in node['items']:
+            index += struct.pack('>Qi', offset, length)
+        addrs = [child['addr'] for child in node['children']]
+        addrs += [0] * (hitomiv2.B + 1 - len(addrs))
+        index += struct.pack(f'>{hitomiv2.B + 1}Q', *addrs)
+    return bytes(index), bytes(data)
+
+
+def zipf_choice(rng: random.Random, population: list[str], k: int = 1) -> list[str]:
+    weights = [1 / (i + 1) for i in range(len(population))]
+    return rng.choices(population, weights=weights, k=k)
+
+
+class FakeCorpus:
+    """
+    确定性生成的画廊集合, 以及对应的全部 ltn 文件 (路径 -> 内容)
+    标题中的单词进入 B 树索引, language / type / female / male / artist 各自生成 nozomi
+    页面内容不预先生成, 由页面哈希按需得到固定的随机字节
+    """
+
+    languages = ['chinese', 'japanese', 'english', 'korean']
+    types = ['doujinshi', 'manga', 'artistcg', 'gamecg']
+
+    def __init__(self, galleries: int = 2000, seed: int = 0, min_pages: int = 10, max_pages: int = 40,
+                 page_size: int = 64 * 1024, version: str = '1', b: str = '1700000000'):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.page_size = page_size
+        self.version = version
+        self.b = b
+        words = [f'word{i}' for i in range(300)]
+        tags = [f'tag{i}' for i in range(120)]
+        artists = [f'artist{i}' for i in range(400)]
+        self.gallery_ids = sorted(rng.sample(range(1, galleries * 50), galleries))
+        self.galleries: dict[int, dict] = {}
+        postings: dict[str, list[int]] = {}
+        nozomi: dict[str, list[int]] = {'index-all': list(self.gallery_ids)}
+        for gallery_id in self.gallery_ids:
+            title_words = list(dict.fromkeys(zipf_choice(rng, words, rng.randint(2, 6))))
+            language = rng.choices(self.languages, weights=[5, 3, 2, 1])[0]
+            gallery_type = rng.choice(self.types)
+            gallery_tags = [(rng.choice(['female', 'male']), tag)
+                            for tag in dict.fromkeys(zipf_choice(rng, tags, rng.randint(3, 15)))]
+            artist = rng.choice(artists)
+            self.galleries[gallery_id] = self.makeGallery(gallery_id, title_words, language, gallery_type,
+                                                          gallery_tags, artist, rng.randint(min_pages, max_pages))
+            for word in title_words:
+                postings.setdefault(word, []).append(gallery_id)
+            keys = [f'index-{language}', f'type/{gallery_type}-all', f'artist/{artist}-all']
+            keys += [f'tag/{sex}-{tag}-all' for sex, tag in gallery_tags]
+            for key in keys:
+                nozomi.setdefault(key, []).append(gallery_id)
+        self.postings = {word: np.asarray(ids) for word, ids in postings.items()}
+        self.nozomi = {key: np.asarray(ids) for key, ids in nozomi.items()}
+        index, data = build_index(self.postings)
+        self.files: dict[str, bytes] = {
+            f'/{hitomiv2.galleries_index_dir}/galleries.{version}.index': index,
+            f'/{hitomiv2.galleries_index_dir}/galleries.{version}.data': data,
+        }
+        for key, ids in self.nozomi.items():
+            self.files[f'/{key}.nozomi'] = np.sort(ids)[::-1].astype('>i4').tobytes()
+        # gg.js: 约三分之一的 inum 映射到第二台图片服务器
+        self.gg_m = {inum: 1 for inum in sorted(rng.sample(range(4096), 1365))}
+
+    def makeGallery(self, gallery_id: int, title_words: list[str], language: str, gallery_type: str,
+                    gallery_tags: list[tuple[str, str]], artist: str, pages: int) -> dict:
+        return {
+            'id': str(gallery_id), 'title': ' '.join(title_words), 'japanese_title': None, 'type': gallery_type,
+            'language': language, 'language_localname': language, 'date': '2024-01-01 00:00:00-05',
+            'datepublished': None, 'galleryurl': f'/{gallery_type}/{"-".join(title_words)}-{gallery_id}.html',
+            'blocked': 0, 'video': None, 'videofilename': None, 'related': [], 'scene_indexes': [],
+            'characters': None, 'groups': None, 'parodys': None,
+            'artists': [{'artist': artist, 'url': f'/artist/{artist}-all.html'}],
+            'languages': [],
+            'tags': [{'tag': tag, 'url': f'/tag/{sex}:{tag}-all.html', sex: 1} for sex, tag in gallery_tags],
+            'files': [{'hasavif': 1, 'hash': hashlib.sha256(f'{self.seed}-{gallery_id}-{i}'.encode()).hexdigest(),
+                       'height': 1600, 'width': 1131, 'name': f'{i:03d}.jpg'} for i in range(pages)],
+        }
+
+    def galleryJs(self, gallery_id: int) -> Optional[bytes]:
+        info = self.galleries.get(gallery_id)
+        if info is None:
+            return None
+        return ('var galleryinfo = ' + json.dumps(info, ensure_ascii=False)).encode('utf-8')
+
+    def ggJs(self) -> bytes:
+        cases = ' '.join(f'case {inum}:' for inum in self.gg_m)
+        return (f"'use strict';\ngg = {{ m: function(g) {{ var o = 0; switch (g) {{ {cases} o = 1; break; }} "
+                f"return o; }}, s: function(h) {{ return h; }}, b: '{self.b}/' }};").encode('ascii')
+
+    def pageBytes(self, image_hash: str) -> bytes:
+        return np.random.default_rng(int(image_hash[:16], 16)).bytes(self.page_size)
+
+
+# ================= HTTP 服务 =================
+
+class FakeHitomiServer:
+    """
+    本地模拟的 Hitomi 服务器 (HTTP/1.1, keep-alive)
+    ltn 域名提供 gg.js / */version / galleries/*.js / nozomi / 索引 (支持 Range 与 HEAD), 其余域名视为图片服务器,
+    按 gg.js 校验 b 路径与服务器编号. 可配置每个请求的延迟、每个连接的带宽, 以及按比例随机注入 503 / 429
+    客户端通过 session() 或 transport() 接入, 请求保留原域名, 只是连接改到本地端口
+    """
+
+    def __init__(self, corpus: FakeCorpus, latency: float = 0.0, bandwidth: Optional[float] = None,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: int = 1,
+                 inject: tuple[str, ...] = ('image',), seed: int = 0):
+        """
+        :param latency: 每个请求在发送响应头前的等待时间 (秒)
+        :param bandwidth: 每个连接的发送速率上限 (字节/秒), None 为不限
+        :param error_rate: 返回 503 的请求比例
+        :param throttle_rate: 返回 429 (带 Retry-After) 的请求比例
+        :param inject: 注入错误的请求类别, 'ltn' 和/或 'image'
+        """
+        self.corpus = corpus
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.inject = inject
+        self.rng = random.Random(seed)
+        self.stats: Counter[str] = Counter()
+        self.host = '127.0.0.1'
+        self.port = 0
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self.host, self.port = host, self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def transport(self) -> 'LocalTransport':
+        return LocalTransport(self.host, self.port)
+
+    def session(self, **kwargs) -> hitomiv2.HitomiSession:
+        return hitomiv2.HitomiSession(transport=self.transport(), **kwargs)
+
+    def rotate(self, b: str):
+        """轮换 gg.js 中的 b 路径, 旧路径的图片请求随即返回 403"""
+        self.corpus.b = b
+
+    def resetStats(self):
+        self.stats.clear()
+
+    # ---------- 路由 ----------
+
+    def resolve(self, host: str, path: str) -> tuple[int, Optional[bytes]]:
+        if host == hitomiv2.domain:
+            if path == '/gg.js':
+                return 200, self.corpus.ggJs()
+            if path.endswith('/version'):
+                return 200, self.corpus.version.encode('ascii')
+            match = re.fullmatch(r'/galleries/(\d+)\.js', path)
+            if match:
+                body = self.corpus.galleryJs(int(match.group(1)))
+                return (200, body) if body is not None else (404, None)
+            body = self.corpus.files.get(path)
+            return (200, body) if body is not None else (404, None)
+        # 图片: /{b}/{inum}/{hash}.{ext}, 域名为 {ext[0]}{m(inum) + 1}.gold-usergeneratedcontent.net
+        match = re.fullmatch(r'/([^/]+)/(\d+)/([0-9a-f]{64})\.(\w+)', path)
+        if not match or not host.endswith(IMAGE_DOMAIN):
+            return 404, None
+        b, inum, image_hash, ext = match.groups()
+        if b != self.corpus.b:
+            return 403, None
+        if host.split('.')[0] != f'{ext[0]}{self.corpus.gg_m.get(int(inum), 0) + 1}':
+            return 404, None
+        return 200, self.corpus.pageBytes(image_hash)
+
+    def respond(self, method: str, host: str, path: str,
+                headers: dict[str, str]) -> tuple[int, dict[str, str], bytes]:
+        kind = 'ltn' if host == hitomiv2.domain else 'image'
+        self.stats[f'{kind}_requests'] += 1
+        if kind in self.inject:
+            roll = self.rng.random()
+            if roll < self.error_rate:
+                self.stats['injected_503'] += 1
+                return 503, {}, b''
+            if roll < self.error_rate + self.throttle_rate:
+                self.stats['injected_429'] += 1
+                return 429, {'Retry-After': str(self.retry_after)}, b''
+        status, body = self.resolve(host, path)
+        if body is None:
+            return status, {}, b''
+        total = len(body)
+        byte_range = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if byte_range is None:
+            return 200, {'Accept-Ranges': 'bytes'}, body
+        start = int(byte_range.group(1))
+        end = min(int(byte_range.group(2)) if byte_range.group(2) else total - 1, total - 1)
+        if start >= total:
+            return 416, {'Content-Range': f'bytes */{total}'}, b''
+        return 206, {'Content-Range': f'bytes {start}-{end}/{total}'}, body[start:end + 1]
+
+    # ---------- 连接处理 ----------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = (await reader.readline()).decode('latin-1').split()
+                if len(request_line) != 3:
+                    return
+                method, target, _ = request_line
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get('content-length', 0) or 0))
+                host = headers.get('host', '').split(':')[0]
+                path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+                status, response_headers, body = self.respond(method.upper(), host, path, headers)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                head = f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\nContent-Length: {len(body)}\r\n'
+                head += ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+                writer.write((head + '\r\n').encode('latin-1'))
+                if method.upper() != 'HEAD':
+                    await self.send(writer, body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer: asyncio.StreamWriter, body: bytes):
+        self.stats['bytes'] += len(body)
+        if not self.bandwidth:
+            writer.write(body)
+            return
+        # 按带宽分块发送, 每块之后等待相应的时间
+        chunk_size = 16 * 1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            writer.write(chunk)
+            await writer.drain()
+            await asyncio.sleep(len(chunk) / self.bandwidth)
+
+
+class LocalTransport(httpx.AsyncBaseTransport):
+    """把所有请求改为明文连接到本地服务器, Host 头保留原域名, 服务器据此区分 ltn 与图片域名"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=100,
+                                                                       max_keepalive_connections=100))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.url = request.url.copy_with(scheme='http', host=self.host, port=self.port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
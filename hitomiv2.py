@@ -1,18 +1,36 @@
 import asyncio
+import bisect
+import contextlib
+import email.utils
+import http
+import io
 import json
+import mmap
 import os
+import random
 import re
+import shutil
+import sqlite3
+import sys
 import tempfile
+import threading
 import time
 import urllib.parse
 import zipfile
-from typing import IO, Callable, Optional, Awaitable, Any, cast
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, AsyncIterator, Callable, Optional, Awaitable, Any
 import httpx
-from pydantic import BaseModel, Field, field_validator
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from tqdm import tqdm
 from setup_logger import getLogger, DEBUG_LEVEL, INFO_LEVEL
 
-logger, setLoggerLevel, _ = getLogger('Hitomi')
+# 日志经由队列交给后台线程输出: 调用处只做消息插值 (及异常堆栈格式化),
+# 控制台/文件格式化与写出都在后台线程; 热路径上不需要调用位置, 省掉每条日志的 findCaller 栈回溯
+logger, setLoggerLevel, _ = getLogger('Hitomi', non_blocking=True, caller_info=False)
 
 domain = 'ltn.gold-usergeneratedcontent.net'
 galleryblockextension = '.html'
@@ -60,27 +78,462 @@ def setDebug(target_state: bool = None):
     return debug
 
 
-search_cache = {}
+class HitomiSession:
+    """
+    长生命周期的 HTTP 会话, 持有 ltn 与各图片域名的连接池
+    批量任务全程复用同一个会话, 每个域名只需握手一次并保持一条热的 HTTP/2 连接
+    """
+
+    def __init__(self,
+                 proxy_url: str | httpx.Proxy | None = None,
+                 ltn_limits: httpx.Limits | None = None,
+                 image_limits: httpx.Limits | None = None,
+                 timeout: float = 20,
+                 image_timeout: float = 5,
+                 http2: bool = True,
+                 transport: httpx.AsyncBaseTransport | None = None):
+        """
+        :param proxy_url: 代理地址, 为 None 时沿用模块级代理设置
+        :param ltn_limits: ltn 域名(索引/元数据)连接池限制
+        :param image_limits: 每个图片域名(a1./b2. ...)各自的连接池限制
+        :param timeout: ltn 请求超时
+        :param image_timeout: 图片请求超时
+        :param http2: 是否启用 HTTP/2 (需安装 httpx[http2])
+        :param transport: 自定义传输层 (如 fake_hitomi 的本地模拟服务器), ltn 与所有图片域名共用, 设置后不再使用代理
+        """
+        if isinstance(proxy_url, str):
+            proxy_url = httpx.Proxy(proxy_url)
+        self.proxy: httpx.Proxy | None = proxy_url if proxy_url is not None else proxy
+        self.ltn_limits = ltn_limits or httpx.Limits(max_keepalive_connections=20, max_connections=20)
+        self.image_limits = image_limits or httpx.Limits(max_keepalive_connections=5, max_connections=5)
+        self.timeout = timeout
+        self.image_timeout = image_timeout
+        self.http2 = http2
+        self.transport = transport
+        if transport is not None:
+            self.proxy = None
+        self.ltn = httpx.AsyncClient(
+            proxy=self.proxy,
+            transport=transport,
+            timeout=timeout,
+            limits=self.ltn_limits,
+            verify=False,  # 如果为了极致速度且信任环境，可关闭 verify (可选)
+            http2=http2
+        )
+        self._image_clients: dict[str, httpx.AsyncClient] = {}
+
+    def imageClient(self, url: str) -> httpx.AsyncClient:
+        """按图片域名取得(必要时创建)对应的连接池"""
+        host = urllib.parse.urlsplit(url).hostname or url
+        client = self._image_clients.get(host)
+        if client is None:
+            client = httpx.AsyncClient(
+                proxy=self.proxy,
+                transport=self.transport,
+                timeout=self.image_timeout,
+                limits=self.image_limits,
+                http2=self.http2
+            )
+            self._image_clients[host] = client
+        return client
+
+    async def aclose(self):
+        clients = [self.ltn, *self._image_clients.values()]
+        self._image_clients.clear()
+        await asyncio.gather(*[client.aclose() for client in clients])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+@contextlib.asynccontextmanager
+async def useSession(session: Optional[HitomiSession] = None, **kwargs):
+    """传入会话则直接复用, 否则创建一个仅在本次调用内有效的临时会话"""
+    if session is not None:
+        yield session
+        return
+    async with HitomiSession(**kwargs) as temp_session:
+        yield temp_session
+
+
+# ================= 指标 =================
+
+# 耗时直方图的分桶上界 (秒)
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """分桶直方图, 语义与 Prometheus histogram 一致"""
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """按分桶估计分位数, 取所在桶的上界"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def formatLabels(labels: tuple[tuple[str, str], ...], extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Metrics:
+    """
+    进程内的计数器与耗时直方图, 按 (指标名, 标签) 聚合
+    默认关闭, 关闭时各个埋点方法立即返回, 不取时间也不加锁
+    """
 
+    def __init__(self):
+        self.enabled = False
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        # ZIP 写入在线程中进行, 更新需要加锁
+        self._lock = threading.Lock()
+
+    def clock(self) -> float:
+        return time.perf_counter() if self.enabled else 0.0
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def phase(self, phase: str, start: float, **labels):
+        """记录从 start (clock() 的返回值) 到现在的耗时"""
+        if not self.enabled:
+            return
+        self.observe('hitomi_phase_seconds', time.perf_counter() - start, phase=phase, **labels)
+
+    def httpTrace(self, host: str) -> Optional[Callable[[str, dict], Awaitable[None]]]:
+        """httpcore trace 回调, 记录建立连接 (DNS + TCP) 与 TLS 握手的耗时"""
+        if not self.enabled:
+            return None
+        started: dict[str, float] = {}
+
+        async def trace(event_name: str, info: dict):
+            step, _, state = event_name.rpartition('.')
+            if state == 'started':
+                started[step] = time.perf_counter()
+            elif state == 'complete' and step in ('connection.connect_tcp', 'connection.start_tls'):
+                self.observe('hitomi_connect_seconds', time.perf_counter() - started.pop(step, time.perf_counter()),
+                             host=host, step=step.rsplit('_', 1)[1])
+
+        return trace
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        declared = set()
+        le_inf = 'le="+Inf"'
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{formatLabels(labels)} {value:g}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    le = f'le="{bound:g}"'
+                    lines.append(f'{name}_bucket{formatLabels(labels, le)} {cumulative}')
+                lines.append(f'{name}_bucket{formatLabels(labels, le_inf)} {histogram.count}')
+                lines.append(f'{name}_sum{formatLabels(labels)} {histogram.total:g}')
+                lines.append(f'{name}_count{formatLabels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """JSON 友好的汇总: 计数器原值, 直方图给出次数/总和/均值与估计的分位数"""
+        result: dict[str, dict] = {'counters': {}, 'histograms': {}}
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                result['counters'].setdefault(name, {})[','.join(f'{k}={v}' for k, v in labels)] = value
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                result['histograms'].setdefault(name, {})[','.join(f'{k}={v}' for k, v in labels)] = {
+                    'count': histogram.count,
+                    'sum': histogram.total,
+                    'mean': histogram.total / histogram.count if histogram.count else 0.0,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99),
+                }
+        return result
+
+
+metrics = Metrics()
+
+
+def setMetrics(enabled: bool = True):
+    """开启 (或关闭) 指标采集, 开启时清空已有数据"""
+    metrics.enabled = enabled
+    if enabled:
+        metrics.reset()
+
+
+class RetryPolicy:
+    """重试策略: 带抖动的指数退避, 服务器给出 Retry-After 时以其为准"""
+
+    def __init__(self, attempts: int = 10, base_delay: float = 0.5, max_delay: float = 30,
+                 max_retry_after: float = 120):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        # full jitter: 在 [0, base * 2^attempt] 内均匀取值, 避免所有协程同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def parseRetryAfter(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After, 支持秒数与 HTTP 日期两种格式"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
 
-async def robustGet(client: httpx.AsyncClient, get_url: str, header=None):
-    logger.debug(f'请求 {get_url}')
-    for itime in range(10):
+
+class HostHealth:
+    """
+    单个域名的健康状态, 所有发往该域名的请求共享
+    - AIMD 并发窗口: 每次成功窗口加 1/窗口 (约每轮加 1), 被限流或失败时减半
+    - 熔断器: 连续失败达到阈值后暂停请求一段时间, 之后只放行一个探测请求, 成功才恢复
+    """
+
+    def __init__(self, host: str, initial_window: float = 16, min_window: float = 1, max_window: float = 256,
+                 failure_threshold: int = 5, base_cooldown: float = 2, max_cooldown: float = 60,
+                 decrease_interval: float = 1):
+        self.host = host
+        self.window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.half_open = False
+        self._last_decrease = 0.0
+        self._waiters: list[asyncio.Future] = []
+
+    def capacity(self) -> int:
+        return 1 if self.half_open else max(int(self.window), 1)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if self.open_until > now:
+                await asyncio.sleep(self.open_until - now)
+                continue
+            if self.in_flight < self.capacity():
+                self.in_flight += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # 已被 _wake 唤醒后才取消: 这个名额必须转交给下一个等待者, 否则它会一直等下去
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, outcome: str):
+        """outcome: ok 成功 / throttled 被限流 / failed 其他失败 / neutral 不计入统计"""
+        self.in_flight -= 1
+        now = time.monotonic()
+        if outcome == 'ok':
+            self.consecutive_failures = 0
+            if self.half_open:
+                logger.info(f'{self.host} 熔断恢复')
+                self.half_open = False
+                self.trips = 0
+            self.window = min(self.window + 1 / self.window, self.max_window)
+        elif outcome in ('throttled', 'failed'):
+            self.consecutive_failures += 1
+            if now - self._last_decrease >= self.decrease_interval:
+                self.window = max(self.window / 2, self.min_window)
+                self._last_decrease = now
+            if self.half_open or self.consecutive_failures >= self.failure_threshold:
+                cooldown = min(self.base_cooldown * 2 ** self.trips, self.max_cooldown)
+                logger.warning(f'{self.host} 连续失败 {self.consecutive_failures} 次, 熔断 {cooldown:.0f}s')
+                self.trips += 1
+                self.consecutive_failures = 0
+                self.open_until = now + cooldown
+                self.half_open = True
+        self._wake()
+
+    def _wake(self):
+        free = self.capacity() - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+retry_policy = RetryPolicy()
+host_health: dict[str, HostHealth] = {}
+
+
+def getHostHealth(url: str) -> HostHealth:
+    host = urllib.parse.urlsplit(url).hostname or url
+    health = host_health.get(host)
+    if health is None:
+        health = host_health[host] = HostHealth(host)
+    return health
+
+
+async def robustRequest(client: httpx.AsyncClient, get_url: str, header=None,
+                        return_status: tuple[int, ...] = (),
+                        on_success: Optional[Callable[[httpx.Response], Awaitable[None]]] = None
+                        ) -> Optional[httpx.Response]:
+    """
+    带重试的流式 GET, 所有请求都经过目标域名的 AIMD 并发窗口与熔断器
+    成功时由 on_success 消费响应体 (默认整体读入内存) 并返回响应; 404/416 或重试耗尽返回 None
+    return_status 中的状态码不重试, 读入响应体后直接返回交给调用方处理
+    429/503 视为限流, 优先按 Retry-After 等待
+    """
+    health = getHostHealth(get_url)
+    trace = metrics.httpTrace(health.host)
+    extensions = {'trace': trace} if trace is not None else None
+    for itime in range(retry_policy.attempts):
+        retry_after = None
+        outcome = 'neutral'
+        # 指标中的状态: HTTP 状态码或异常类型
+        result = 'error'
+        wait_start = metrics.clock()
+        await health.acquire()
+        metrics.phase('host_wait', wait_start, host=health.host)
+        start = metrics.clock()
         try:
-            response = await client.get(get_url, headers=header)
-            if 200 <= response.status_code < 300:
-                return response
-            elif response.status_code == 404:
-                return None
-            else:
-                if itime > 2:
-                    logger.warning(f'服务器返回{response.status_code}, 当前次数 {itime}')
+            async with client.stream('GET', get_url, headers=header, extensions=extensions) as response:
+                status = response.status_code
+                result = status
+                if 200 <= status < 300:
+                    if on_success is None:
+                        await response.aread()
+                    else:
+                        await on_success(response)
+                    outcome = 'ok'
+                    metrics.inc('hitomi_http_bytes_total', response.num_bytes_downloaded, host=health.host)
+                    return response
+                elif status in return_status:
+                    await response.aread()
+                    return response
+                elif status in (404, 416):
+                    # 416: Range 超出文件长度 (例如空文件), 重试没有意义
+                    return None
+                if status in (429, 503):
+                    outcome = 'throttled'
+                    retry_after = parseRetryAfter(response.headers.get('Retry-After'))
+                else:
+                    outcome = 'failed'
+                if itime > 2 or retry_after is not None:
+                    logger.warning(f'服务器返回{status}, 当前次数 {itime}')
         except Exception as e:
+            outcome = 'throttled' if isinstance(e, httpx.TimeoutException) else 'failed'
+            result = type(e).__name__
             logger.warning(f'请求错误: {type(e)}:{e}')
-        await asyncio.sleep(0.5 * (itime + 1))
+        finally:
+            health.release(outcome)
+            if metrics.enabled:
+                metrics.inc('hitomi_http_requests_total', host=health.host, status=result)
+                metrics.observe('hitomi_http_request_seconds', time.perf_counter() - start, host=health.host)
+        # 最后一次尝试失败后直接返回, 不再计入重试也不再等待
+        if itime + 1 < retry_policy.attempts:
+            metrics.inc('hitomi_http_retries_total', host=health.host, reason=result)
+            await asyncio.sleep(retry_policy.delay(itime, retry_after))
     return None
 
 
+async def robustGet(client: httpx.AsyncClient, get_url: str, header=None, return_status: tuple[int, ...] = ()):
+    """
+    带重试的 GET 请求, 成功返回响应, 404 或重试耗尽返回 None
+    return_status 中的状态码不重试, 直接把响应交给调用方处理
+    """
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'请求 {get_url}')
+    return await robustRequest(client, get_url, header, return_status)
+
+
+async def robustDownload(client: httpx.AsyncClient, get_url: str, file: IO[bytes], header=None,
+                         return_status: tuple[int, ...] = (), chunk_size: int = 64 * 1024) -> Optional[int]:
+    """
+    带重试的流式 GET, 响应体按块写入 file, 内存中最多只有一个块
+    每次尝试前都会清空 file, 中途失败的重试不会留下残缺数据
+    成功返回状态码, 404 或重试耗尽返回 None; return_status 中的状态码直接返回, 不写入 file
+    """
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'流式请求 {get_url}')
+
+    async def write_body(response: httpx.Response):
+        file.seek(0)
+        file.truncate()
+        async for chunk in response.aiter_bytes(chunk_size):
+            file.write(chunk)
+        file.seek(0)
+
+    response = await robustRequest(client, get_url, header, return_status, on_success=write_body)
+    return response.status_code if response is not None else None
+
+
 async def setGG(client: httpx.AsyncClient, add_timestamp=False):
     if add_timestamp:
         gg_url = f'https://ltn.gold-usergeneratedcontent.net/gg.js?_={int(time.time() * 1000)}'
@@ -106,6 +559,66 @@ async def setGG(client: httpx.AsyncClient, add_timestamp=False):
     return m, b.group(1).strip("/"), int(d.group(1)) if d else 0
 
 
+GGTable = tuple[dict[int, int], str, int]
+
+
+class GGCache:
+    """
+    gg.js 路由表 (m, b, d) 的进程级缓存
+    过期前所有下载共用同一份表; 同时发起的多个请求只会触发一次 gg.js 拉取
+    """
+
+    def __init__(self, ttl: float = 600, min_refresh_interval: float = 10):
+        """
+        :param ttl: 缓存有效期 (秒)
+        :param min_refresh_interval: 因图片 403/404 强制刷新时的最小间隔, 防止真正缺失的图片反复触发刷新
+        """
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.table: Optional[GGTable] = None
+        self.fetched_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self, client: httpx.AsyncClient) -> GGTable:
+        if self.table is not None and time.monotonic() - self.fetched_at < self.ttl:
+            return self.table
+        return await self._refresh(client, bust_cache=False)
+
+    async def invalidate(self, client: httpx.AsyncClient, stale: GGTable) -> GGTable:
+        """
+        图片请求返回 403/404 时调用, stale 为生成该图片地址所用的路由表
+        若它仍是当前的表则重新拉取 (带时间戳绕过 CDN 缓存), 已被其他请求刷新过则直接返回新表
+        """
+        if self.table is not stale or time.monotonic() - self.fetched_at < self.min_refresh_interval:
+            return await self.get(client)
+        logger.info(f'图片请求失败, 刷新 gg.js (旧 b: {stale[1]})')
+        self.table = None
+        return await self._refresh(client, bust_cache=True)
+
+    async def _refresh(self, client: httpx.AsyncClient, bust_cache: bool) -> GGTable:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._fetch(client, bust_cache))
+        return await asyncio.shield(self._task)
+
+    async def _fetch(self, client: httpx.AsyncClient, bust_cache: bool) -> GGTable:
+        try:
+            table = await setGG(client, add_timestamp=bust_cache)
+            self.table = table
+            self.fetched_at = time.monotonic()
+            logger.debug(f'gg.js 已刷新, b: {table[1]}')
+            return table
+        finally:
+            self._task = None
+
+
+gg_cache = GGCache()
+
+
+def setGGCacheTTL(ttl: float):
+    gg_cache.ttl = ttl
+
+
 class Language(BaseModel):
     name: str
     galleryid: int
@@ -125,22 +638,15 @@ class Group(BaseModel):
 
 
 class Tag(BaseModel):
+    # 原始输入中 female/male 可能为 int, 由 pydantic-core 直接强转为 str,
+    # 解决 tags.x.female 报错 [input_value=1, input_type=int], 且不必为每个 tag 回调 Python 验证器
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
     tag: str
     url: str
     male: Optional[str] = ""
     female: Optional[str] = ""
 
-    @field_validator('male', 'female', mode='before')
-    @classmethod
-    def coerce_int_to_str(cls, v):
-        """
-        拦截原始输入：若为 int 则强转为 str，
-        解决 tags.x.female 报错 [input_value=1, input_type=int]
-        """
-        if isinstance(v, int):
-            return str(v)
-        return v
-
 
 class PageInfo(BaseModel):
     hasavif: int
@@ -209,16 +715,15 @@ class Comic(BaseModel):
     def prevent_characters_none(cls, v):
         if v is None:
             return []
-        return (v
+        return v
 
-    @field_validator('artists', mode='before'))
+    @field_validator('artists', mode='before')
     @classmethod
     def prevent_artists_none(cls, v):
         if v is None:
             return []
         return v
 
-
     # 针对 id 的预处理验证器
     @field_validator('id', mode='before')
     @classmethod
@@ -232,111 +737,520 @@ class Comic(BaseModel):
         return v
 
 
-async def decodeDownloadUrls(files: list[PageInfo]) -> dict[str, str]:
-    limits = httpx.Limits(max_keepalive_connections=5, max_connections=5)
-    async with httpx.AsyncClient(
-            proxy=proxy,
-            timeout=5,
-            limits=limits,
-            verify=False,  # 如果为了极致速度且信任环境，可关闭 verify (可选)
-            http2=True  # 如果服务器支持 HTTP/2，速度会起飞 (可选，需安装 httpx[http2])
-    ) as client:
-        gg_m, gg_b, gg_d = await setGG(client)
+class ComicHead(BaseModel):
+    """ComicSummary 构造时实际校验的字段, 其余字段由 pydantic-core 在解析 JSON 时直接跳过"""
+    id: str
+    title: str
+    type: str
+    language: str
+    date: str
+    tags: Optional[list[Tag]] = None
+
+    @field_validator('id', mode='before')
+    @classmethod
+    def coerce_id_to_str(cls, v):
+        if isinstance(v, int):
+            return str(v)
+        return v
 
-    # noinspection PyUnusedLocal
-    def url2hash(galleryid, image: PageInfo, ext=None):
-        # 修改点 1: image['name'] -> image.name
-        # 注意：保留了原代码中的逻辑（虽然 'or image.name...' 这部分永远不会执行）
-        ext = ext or "webp" or image.name.split('.').pop()
-        # 修改点 2: image["hash"] -> image.hash
-        ihash = image.hash
-        # 核心逻辑保持不变
-        inum = int(ihash[-1] + ihash[-3:-1], 16)
-        url = "https://{}{}.{}/{}/{}/{}.{}".format(
-            ext[0],
-            gg_m.get(inum, gg_d) + 1,
-            "gold-usergeneratedcontent.net",
-            gg_b,
-            inum,
-            ihash,
-            ext,
-        )
-        return url
 
+def tagTerm(tag: Tag) -> str:
+    """Tag 转为搜索语法中的 'female:xxx' / 'male:xxx' / 'tag:xxx' 形式"""
+    if tag.female:
+        return f'female:{tag.tag}'
+    if tag.male:
+        return f'male:{tag.tag}'
+    return f'tag:{tag.tag}'
+
+
+class ComicSummary:
+    """
+    画廊元数据的轻量视图, 用于搜索结果列表等需要一次持有大量画廊的场景
+    构造时只校验 id / title / type / language / date / tags, tags 转为驻留的 tagTerm 字符串,
+    同一个 tag 在所有画廊间共享一个对象; 原始 JSON 原样保留为 bytes,
+    files 等其余字段在首次访问时才整体校验为 Comic
+    """
+    __slots__ = ('id', 'title', 'type', 'language', 'date', 'tags', 'raw', '_comic')
+
+    def __init__(self, raw: bytes):
+        head = ComicHead.model_validate_json(raw)
+        self.id = head.id
+        self.title = head.title
+        self.type = sys.intern(head.type)
+        self.language = sys.intern(head.language)
+        self.date = head.date
+        self.tags = tuple(sys.intern(tagTerm(tag)) for tag in head.tags or ())
+        self.raw = raw
+        self._comic: Optional[Comic] = None
+
+    def comic(self) -> Comic:
+        """完整的 Comic, 首次调用时校验并缓存"""
+        if self._comic is None:
+            self._comic = Comic.model_validate_json(self.raw)
+        return self._comic
+
+    def __getattr__(self, name: str):
+        # 只有摘要之外的字段 (files / languages / artists ...) 才会走到这里
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.comic(), name)
+
+    def __repr__(self) -> str:
+        return f'ComicSummary(id={self.id!r}, title={self.title!r}, tags={len(self.tags)})'
+
+
+def imageName(image: PageInfo) -> str:
+    return re.sub(r'\.[^.]+$', '.webp', image.name)
+
+
+def imageUrl(image: PageInfo, gg_table: GGTable, ext: str = None) -> str:
+    gg_m, gg_b, gg_d = gg_table
+    # 注意：保留了原代码中的逻辑（虽然 'or image.name...' 这部分永远不会执行）
+    ext = ext or "webp" or image.name.split('.').pop()
+    ihash = image.hash
+    # 核心逻辑保持不变
+    inum = int(ihash[-1] + ihash[-3:-1], 16)
+    url = "https://{}{}.{}/{}/{}/{}.{}".format(
+        ext[0],
+        gg_m.get(inum, gg_d) + 1,
+        "gold-usergeneratedcontent.net",
+        gg_b,
+        inum,
+        ihash,
+        ext,
+    )
+    return url
+
+
+async def decodeDownloadUrls(files: list[PageInfo], session: Optional[HitomiSession] = None) -> dict[str, str]:
+    async with useSession(session) as session:
+        gg_table = await gg_cache.get(session.ltn)
     download_urls = {}
     for file in files:
-        # 修改点 3: file['name'] -> file.name
-        image_name = re.sub(r'\.[^.]+$', '.webp', file.name)
-        # 传入 Pydantic 对象 file
-        download_urls[image_name] = url2hash(0, file, None)
+        download_urls[imageName(file)] = imageUrl(file, gg_table)
     return download_urls
 
 
-async def refreshVersion():
-    for version_name, version in index_versions.items():
-        if version_name == index_dir:
-            continue
-        url = f'https://{domain}/{version_name}/version?_={int(time.time() * 1000)}'
-        logger.debug(f'请求url: {url}')
-        limits = httpx.Limits(max_keepalive_connections=20, max_connections=20)
-        async with httpx.AsyncClient(
-                proxy=proxy,
-                timeout=20,
-                limits=limits,
-                verify=False,  # 如果为了极致速度且信任环境，可关闭 verify (可选)
-                http2=True  # 如果服务器支持 HTTP/2，速度会起飞 (可选，需安装 httpx[http2])
-        ) as client:
-            response = await robustGet(client, url)
-        version = response.text
-        if not version:
-            logger.error(f'refresh_versions: getting {version_name} failed')
-        else:
-            logger.debug(f'{version_name}:{version}')
-            index_versions[version_name] = version
-            break
-        if version == '':
-            raise ConnectionError(f'{version_name} failed totally')
+async def refreshVersion(session: Optional[HitomiSession] = None):
+    async with useSession(session) as session:
+        for version_name, version in index_versions.items():
+            if version_name == index_dir:
+                continue
+            url = f'https://{domain}/{version_name}/version?_={int(time.time() * 1000)}'
+            logger.debug(f'请求url: {url}')
+            response = await robustGet(session.ltn, url)
+            version = response.text
+            if not version:
+                logger.error(f'refresh_versions: getting {version_name} failed')
+            else:
+                logger.debug(f'{version_name}:{version}')
+                if version_name == galleries_index_dir:
+                    btree_cache.invalidate(version)
+                    search_cache.invalidate(version)
+                index_versions[version_name] = version
+                break
+            if version == '':
+                raise ConnectionError(f'{version_name} failed totally')
 
 
-async def getComic(gallery_id) -> Optional[Comic]:
+class ComicStore:
+    """
+    本地 SQLite 画廊元数据缓存
+    画廊元数据基本不会变化, 校验通过的 Comic 以 JSON 形式按 id 存储, 之后直接从本地读取
+    """
+
+    def __init__(self, path: str | Path = 'comics.sqlite3'):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS comics ('
+                           'id INTEGER PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)')
+        self._conn.commit()
+
+    def get(self, gallery_id: int | str) -> Optional[Comic]:
+        row = self._conn.execute('SELECT data FROM comics WHERE id = ?', (int(gallery_id),)).fetchone()
+        return Comic.model_validate_json(row[0]) if row else None
+
+    def getMany(self, gallery_ids: list[int], summary: bool = False) -> dict[int, Comic | ComicSummary]:
+        """summary=True 时返回 ComicSummary, 数据以 bytes 读出, 不做完整校验"""
+        found = {}
+        parse = ComicSummary if summary else Comic.model_validate_json
+        # SQLite 单条语句的参数个数有限, 分批查询
+        for i in range(0, len(gallery_ids), 500):
+            batch = gallery_ids[i:i + 500]
+            rows = self._conn.execute(
+                f'SELECT id, CAST(data AS BLOB) FROM comics WHERE id IN ({",".join("?" * len(batch))})', batch)
+            for gallery_id, data in rows:
+                found[gallery_id] = parse(data)
+        return found
+
+    def put(self, comics: list[Comic | ComicSummary]):
+        """ComicSummary 直接写入其原始 JSON, 读取时仍由 Comic 完整校验"""
+        now = time.time()
+        self._conn.executemany('INSERT OR REPLACE INTO comics (id, data, fetched_at) VALUES (?, ?, ?)',
+                               [(int(comic.id), comic_json(comic), now) for comic in comics])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def comic_json(comic: Comic | ComicSummary) -> str:
+    if isinstance(comic, ComicSummary):
+        return comic.raw.decode('utf-8')
+    return comic.model_dump_json()
+
+
+comic_store: Optional[ComicStore] = None
+
+
+def setComicStore(path: Optional[str | Path]):
+    """启用 (或传入 None 关闭) 本地元数据缓存, getComic / getComics 会优先从中读取"""
+    global comic_store
+    if comic_store is not None:
+        comic_store.close()
+    comic_store = ComicStore(path) if path is not None else None
+
+
+async def getComic(gallery_id, session: Optional[HitomiSession] = None) -> Optional[Comic]:
+    if comic_store is not None:
+        comic = comic_store.get(gallery_id)
+        if comic is not None:
+            return comic
+    async with useSession(session) as session:
+        comic = await fetchComic(gallery_id, session.ltn)
+    if comic is not None and comic_store is not None:
+        comic_store.put([comic])
+    return comic
+
+
+async def getComics(gallery_ids: list[int], concurrency: int = 20, session: Optional[HitomiSession] = None,
+                    summary: bool = False) -> AsyncIterator[Comic | ComicSummary]:
+    """
+    批量获取画廊元数据
+    本地缓存命中的先按顺序产出, 未命中的在同一个会话上并发获取, 按完成顺序产出并写入缓存
+    不存在的画廊会被跳过
+    summary=True 时产出 ComicSummary, 适合只需要标题 / tags 的大批量列表
+    """
+    cached = comic_store.getMany(gallery_ids, summary) if comic_store is not None else {}
+    for gallery_id in gallery_ids:
+        if gallery_id in cached:
+            yield cached[gallery_id]
+    misses = [gallery_id for gallery_id in dict.fromkeys(gallery_ids) if gallery_id not in cached]
+    if not misses:
+        return
+    async with useSession(session) as session:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def fetch(gallery_id: int) -> Optional[Comic | ComicSummary]:
+            async with sem:
+                try:
+                    return await fetchComic(gallery_id, session.ltn, summary)
+                except Exception as e:
+                    logger.error(f'{gallery_id} 元数据获取失败: {type(e)}:{e}')
+                    return None
+
+        tasks = [asyncio.ensure_future(fetch(gallery_id)) for gallery_id in misses]
+        fetched: list[Comic | ComicSummary] = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                comic = await next_done
+                if comic is None:
+                    continue
+                fetched.append(comic)
+                # 分批写入, 避免中途退出时丢失太多结果
+                if comic_store is not None and len(fetched) >= 100:
+                    comic_store.put(fetched)
+                    fetched = []
+                yield comic
+        finally:
+            for task in tasks:
+                task.cancel()
+            if comic_store is not None and fetched:
+                comic_store.put(fetched)
+
+
+async def fetchComic(gallery_id, client: httpx.AsyncClient,
+                     summary: bool = False) -> Optional[Comic | ComicSummary]:
+    """从服务器获取并解析画廊元数据, 不经过本地缓存"""
     req_url = f'https://{domain}/galleries/{gallery_id}.js'
-    limits = httpx.Limits(max_keepalive_connections=20, max_connections=20)
-    async with httpx.AsyncClient(
-            proxy=proxy,
-            timeout=20,
-            limits=limits,
-            verify=False,  # 如果为了极致速度且信任环境，可关闭 verify (可选)
-            http2=True  # 如果服务器支持 HTTP/2，速度会起飞 (可选，需安装 httpx[http2])
-    ) as client:
-        response = await robustGet(client, req_url)
+    response = await robustGet(client, req_url)
     if response is None:
         return None
-    # 使用正则表达式匹配 galleryinfo 变量的 JSON 对象
-    if 'galleryinfo' not in response.text:
-        logger.error(response.text)
+    if summary:
+        return parseGallerySummary(response.content)
+    return parseGalleryInfo(response.content)
+
+
+def galleryinfo_json(raw: bytes) -> bytes:
+    """从 galleries/{id}.js 的原始字节中切出 galleryinfo 对象的 JSON"""
+    if b'galleryinfo' not in raw:
+        logger.error(raw[:200])
         raise ValueError("galleryinfo not found")
-    match = re.search(r'{.*', response.text, re.DOTALL)
-    # 提取匹配的 JSON 字符串
-    json_str = match.group(0)
-    # 解析 JSON 字符串为 Python 字典
-    try:
-        galleryinfo_dict = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Error decoding JSON: {e}")
-    return Comic.model_validate(galleryinfo_dict)
+    start = raw.find(b'{')
+    end = raw.rfind(b'}') + 1
+    if start < 0 or end <= start:
+        raise ValueError("galleryinfo not found")
+    return raw[start:end]
+
+
+def parseGalleryInfo(raw: bytes) -> Comic:
+    """
+    从 galleries/{id}.js 的原始字节中切出 galleryinfo 对象, 交给 pydantic 一次完成解析与校验
+    不再经过 文本解码 -> 正则 -> json.loads -> model_validate 的多轮复制
+    """
+    data = galleryinfo_json(raw)
+    clock = metrics.clock()
+    comic = Comic.model_validate_json(data)
+    metrics.phase('metadata_parse', clock)
+    return comic
+
+
+def parseGallerySummary(raw: bytes) -> ComicSummary:
+    """同 parseGalleryInfo, 但只校验摘要字段, 见 ComicSummary"""
+    data = galleryinfo_json(raw)
+    clock = metrics.clock()
+    summary = ComicSummary(data)
+    metrics.phase('metadata_parse', clock)
+    return summary
+
+
+class DownloadJournal:
+    """
+    单个画廊的断点续传记录
+    页面先写入 staging 目录下的 .part 文件, 完整下载后改名为其内容哈希并追加一行到 journal
+    重启时 journal 中记录且大小吻合的页直接从磁盘读取, 只下载缺失的页;
+    已登记的页只交出路径, 由调用方在写入归档时再打开, 大画廊续传时不会同时占用大量文件描述符
+    """
+
+    def __init__(self, resume_dir: str | Path, gallery_id: str):
+        self.dir = Path(resume_dir) / str(gallery_id)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.dir / 'journal'
+        self.done: dict[str, int] = {}
+        if self.journal_path.is_file():
+            for line in self.journal_path.read_text(encoding='utf-8').splitlines():
+                page_hash, _, size = line.partition(' ')
+                page_path = self.dir / page_hash
+                if size.isdigit() and page_path.is_file() and page_path.stat().st_size == int(size):
+                    self.done[page_hash] = int(size)
+        if self.done:
+            logger.info(f'{gallery_id} 续传: 已有 {len(self.done)} 页')
+
+    def staged(self, page_hash: str) -> Optional[Path]:
+        if page_hash not in self.done:
+            return None
+        return self.dir / page_hash
+
+    def partFile(self) -> IO[bytes]:
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=self.dir)
+        os.close(fd)
+        return open(part_path, 'w+b')
+
+    def commit(self, page_hash: str, part: IO[bytes]) -> Path:
+        """将完整下载的 .part 文件登记为已完成 (并关闭), 返回页面文件的路径"""
+        part.flush()
+        size = os.fstat(part.fileno()).st_size
+        part.close()
+        page_path = self.dir / page_hash
+        os.replace(part.name, page_path)
+        with open(self.journal_path, 'a', encoding='utf-8') as journal:
+            journal.write(f'{page_hash} {size}\n')
+        self.done[page_hash] = size
+        return page_path
+
+    @staticmethod
+    def discard(part: IO[bytes]):
+        part.close()
+        with contextlib.suppress(OSError):
+            os.unlink(part.name)
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class PageStore:
+    """
+    按页面哈希寻址的本地图片库
+    PageInfo.hash 唯一确定一页图片, 不同画廊 (转载 / 翻译版) 中哈希相同的页只需下载一次;
+    文件保存在 root/{hash 末两位}/{hash}, 大小与最近使用时间记录在 root/index.sqlite3,
+    总大小超过 max_bytes 时按最近最少使用淘汰, 一次淘汰到 max_bytes * low_water 以下
+    """
+
+    # 每批淘汰的条目数
+    EVICT_BATCH = 256
+
+    def __init__(self, root: str | Path = 'pages', max_bytes: int = 10 * 1024 ** 3, low_water: float = 0.9):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        # put 在线程中执行 (复制页面文件), 连接由锁保护
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.root / 'index.sqlite3', check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                           'hash TEXT PRIMARY KEY, size INTEGER NOT NULL, used_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at)')
+        self._conn.commit()
+        self.total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    def pagePath(self, page_hash: str) -> Path:
+        return self.root / page_hash[-2:] / page_hash
+
+    def lookup(self, page_hash: str) -> Optional[Path]:
+        """
+        命中时返回页面文件的路径并刷新其使用时间, 索引与文件不一致的记录直接丢弃
+        文件由调用方在写入归档时才打开, 期间可能已被淘汰
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM pages WHERE hash = ?', (page_hash,)).fetchone()
+            if row is None:
+                return None
+            page_path = self.pagePath(page_hash)
+            try:
+                size = page_path.stat().st_size
+            except OSError:
+                size = None
+            if size != row[0]:
+                self._remove(page_hash, row[0])
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE pages SET used_at = ? WHERE hash = ?', (time.time(), page_hash))
+            self._conn.commit()
+            return page_path
+
+    def touch(self, page_hashes: list[str]):
+        """
+        刷新一批页的使用时间
+        画廊开始下载前调用, 避免本画廊新下载的页在查找之前就把库中已有的同画廊页淘汰掉
+        """
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(page_hashes), 500):
+                batch = page_hashes[i:i + 500]
+                self._conn.execute(f'UPDATE pages SET used_at = ? WHERE hash IN ({",".join("?" * len(batch))})',
+                                   [now, *batch])
+            self._conn.commit()
+
+    def put(self, page_hash: str, file_data: IO[bytes]):
+        """复制一份完整下载的页面入库, file_data 读取位置保持在开头"""
+        page_path = self.pagePath(page_hash)
+        page_path.parent.mkdir(exist_ok=True)
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=page_path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as part:
+                shutil.copyfileobj(file_data, part)
+            os.replace(part_path, page_path)
+        except OSError as e:
+            with contextlib.suppress(OSError):
+                os.unlink(part_path)
+            logger.warning(f'{page_hash} 写入图片库失败: {e}')
+            return
+        finally:
+            file_data.seek(0)
+        size = page_path.stat().st_size
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM pages WHERE hash = ?', (page_hash,)).fetchone()
+            self.total += size - (row[0] if row else 0)
+            self._conn.execute('INSERT OR REPLACE INTO pages (hash, size, used_at) VALUES (?, ?, ?)',
+                               (page_hash, size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def _remove(self, page_hash: str, size: int):
+        with contextlib.suppress(OSError):
+            os.unlink(self.pagePath(page_hash))
+        self._conn.execute('DELETE FROM pages WHERE hash = ?', (page_hash,))
+        self.total -= size
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        # 超出上限后一次淘汰到低水位, 避免之后每存一页都要淘汰; 按 used_at 索引分批读取, 不扫描全表
+        target = self.max_bytes * self.low_water
+        while self.total > target:
+            rows = self._conn.execute('SELECT hash, size FROM pages ORDER BY used_at LIMIT ?',
+                                      (self.EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            for page_hash, size in rows:
+                if self.total <= target:
+                    break
+                self._remove(page_hash, size)
+                metrics.inc('hitomi_page_store_evictions_total')
+
+    def close(self):
+        self._conn.close()
+
+
+page_store: Optional[PageStore] = None
+
+
+def setPageStore(root: Optional[str | Path], max_bytes: int = 10 * 1024 ** 3):
+    """启用 (或传入 None 关闭) 本地图片库, downloadComic 会先从中读取哈希相同的页"""
+    global page_store
+    if page_store is not None:
+        page_store.close()
+    page_store = PageStore(root, max_bytes) if root is not None else None
+
+
+class PageLimiter:
+    """
+    图片请求的并发预算: 全局并发上限 + 每个图片域名的并发上限
+    多个画廊共用同一个 PageLimiter 时, 它们的页面请求共享这份预算
+    """
+
+    def __init__(self, concurrency: int = 5, per_host: Optional[int] = None):
+        self.concurrency = concurrency
+        self.per_host = per_host or concurrency
+        self._global: Optional[asyncio.Semaphore] = None
+        self._hosts: dict[str, asyncio.Semaphore] = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url: str):
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.concurrency)
+        host = urllib.parse.urlsplit(url).hostname or url
+        host_sem = self._hosts.get(host)
+        if host_sem is None:
+            host_sem = self._hosts[host] = asyncio.Semaphore(self.per_host)
+        async with host_sem:
+            async with self._global:
+                yield
 
 
 async def downloadComic(comic: Comic, file: IO[bytes],
                         max_threads=5,
-                        phase_callback: Callable[[str], Awaitable[None]] = None) -> bool:
+                        phase_callback: Callable[[str], Awaitable[None]] = None,
+                        session: Optional[HitomiSession] = None,
+                        resume_dir: Optional[str | Path] = None,
+                        limiter: Optional[PageLimiter] = None) -> bool:
+    """
+    下载画廊并写入可复现的 ZIP
+    指定 resume_dir 时启用断点续传: 页面暂存于 resume_dir/{id}/, 单页失败不会中断其他页,
+    全部完成后才打包并清理暂存目录; 有页失败时抛出 ConnectionError, 重新调用即可只补齐缺失的页
+    limiter 用于在多个画廊间共享并发预算, 不传时按 max_threads 单独限流
+    启用 setPageStore 时, 图片库中已有的页直接从磁盘读取, 新下载的页同时存入图片库
+    """
     if not comic.files:
         logger.warning(f'comic has no files')
         return False
+    journal = DownloadJournal(resume_dir, comic.id) if resume_dir is not None else None
+    limiter = limiter or PageLimiter(max_threads)
+    async with useSession(session, image_limits=httpx.Limits(max_keepalive_connections=max_threads,
+                                                             max_connections=max_threads)) as session:
+        return await _downloadComic(comic, file, limiter, phase_callback, session, journal)
+
+
+async def _downloadComic(comic: Comic, file: IO[bytes],
+                         limiter: PageLimiter,
+                         phase_callback: Optional[Callable[[str], Awaitable[None]]],
+                         session: HitomiSession,
+                         journal: Optional[DownloadJournal]) -> bool:
     headers = {'referer': 'https://hitomi.la' + urllib.parse.quote(comic.galleryurl)}
     pbar: Optional[tqdm] = None
-    file_urls = await decodeDownloadUrls(comic.files)
+    pages = {imageName(page): page for page in comic.files}
     if phase_callback is None:
-        pbar = tqdm(total=len(file_urls), desc="Downloading", unit="file")
+        pbar = tqdm(total=len(pages), desc="Downloading", unit="file")
 
     # noinspection PyUnusedLocal
     async def _tqdm_callback(dl_url: str):
@@ -344,43 +1258,336 @@ async def downloadComic(comic: Comic, file: IO[bytes],
 
     if phase_callback is None:
         phase_callback = _tqdm_callback
-    sem = asyncio.Semaphore(max_threads)
-
-    async def download_file(_sem: asyncio.Semaphore, client: httpx.AsyncClient, url_name: str, url: str) -> tuple[
-        str, tempfile.SpooledTemporaryFile]:
-        async with _sem:
-            response = await robustGet(client, url, header=headers)
-            f = tempfile.SpooledTemporaryFile(max_size=1024 ** 2)
-            f.write(response.content)
-            f.seek(0)
+
+    async def download_file(url_name: str, page: PageInfo, use_store: bool = True) -> tuple[str, Path | IO[bytes]]:
+        """返回页面名与页面数据: 已落盘的页只返回路径, 写入归档时再打开"""
+        if journal is not None:
+            staged = journal.staged(page.hash)
+            if staged is not None:
+                await phase_callback(url_name)
+                return url_name, staged
+        if page_store is not None and use_store:
+            stored = page_store.lookup(page.hash)
+            metrics.inc('hitomi_page_store_lookups_total', result='hit' if stored is not None else 'miss')
+            if stored is not None:
+                await phase_callback(url_name)
+                return url_name, stored
+        table = await gg_cache.get(session.ltn)
+        url = imageUrl(page, table)
+        async with limiter.slot(url):
+            # 直接落盘, 内存占用只与块大小和并发数相关
+            f = journal.partFile() if journal is not None else tempfile.TemporaryFile()
+            status = await robustDownload(session.imageClient(url), url, f, header=headers, return_status=(403, 404))
+            if status in (403, 404):
+                # 图片服务器拒绝通常意味着 gg.js 中的 b 路径已轮换
+                table = await gg_cache.invalidate(session.ltn, table)
+                url = imageUrl(page, table)
+                status = await robustDownload(session.imageClient(url), url, f, header=headers)
+            if status is None:
+                if journal is not None:
+                    journal.discard(f)
+                else:
+                    f.close()
+                raise ConnectionError(f'{url_name} 下载失败: {url}')
+            if page_store is not None:
+                await asyncio.to_thread(page_store.put, page.hash, f)
             await phase_callback(url)
+            if journal is not None:
+                return url_name, journal.commit(page.hash, f)
             return url_name, f
 
-    limits = httpx.Limits(max_keepalive_connections=max_threads, max_connections=max_threads)
-    async with httpx.AsyncClient(
-            proxy=proxy,
-            timeout=5,
-            limits=limits,
-            http2=True  # 如果服务器支持 HTTP/2，速度会起飞 (可选，需安装 httpx[http2])
-    ) as client_o:
-        tasks = [download_file(sem, client_o, name, url) for name, url in file_urls.items()]
-        downloaded_files_data = cast(
-            list[tuple[str, tempfile.SpooledTemporaryFile]],
-            cast(object, await asyncio.gather(*tasks))
-        )
-
-
-    # 哈希级可复现构建, 勿修改任何打包流程
-    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for file_name, file_data in downloaded_files_data:
-            zinfo = zipfile.ZipInfo(file_name, date_time=(1980, 1, 1, 0, 0, 0))
-            zinfo.external_attr = 0o100644 << 16
-            zinfo.compress_type = zipfile.ZIP_DEFLATED
-            zipf.writestr(zinfo, file_data.read())
+    async def open_page(url_name: str, source: Path | IO[bytes]) -> IO[bytes]:
+        if not isinstance(source, Path):
+            return source
+        try:
+            return open(source, 'rb')
+        except FileNotFoundError:
+            # 图片库中的页在轮到写入之前被淘汰, 跳过图片库重新下载
+            _, source = await download_file(url_name, pages[url_name], use_store=False)
+            return open(source, 'rb') if isinstance(source, Path) else source
+
+    if page_store is not None:
+        page_store.touch([page.hash for page in pages.values()])
+    tasks = [asyncio.ensure_future(download_file(name, page)) for name, page in pages.items()]
+    failures: list[Exception] = []
+    try:
+        # 哈希级可复现构建, 勿修改任何打包流程
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            writer = ParallelZipWriter(zipf)
+            # 按固定顺序等待, 轮到哪一页就写哪一页; 提前完成的页暂存在各自的临时文件中
+            for task in tasks:
+                try:
+                    file_name, source = await task
+                except Exception as e:
+                    # 续传模式下单页失败不影响其他页继续下载并登记
+                    if journal is None:
+                        raise
+                    logger.warning(f'{e}')
+                    failures.append(e)
+                    continue
+                if failures:
+                    # 本次归档已作废, 只需让其余页完成暂存
+                    if not isinstance(source, Path):
+                        source.close()
+                    continue
+                # 已落盘的页轮到写入时才打开, 同时打开的页面文件数受压缩窗口限制, 与画廊页数无关
+                file_data = await open_page(file_name, source)
+                # 压缩在线程池中并行进行, 不阻塞其他页的下载, 写出顺序不变
+                await writer.add(file_name, file_data)
+            if not failures:
+                await writer.finish()
+    finally:
+        for task in tasks:
+            task.cancel()
+    if failures:
+        raise ConnectionError(f'{len(failures)} 页下载失败, 已完成的页保存在 {journal.dir}, 重新下载即可续传')
+    if journal is not None:
+        journal.cleanup()
     file.seek(0)
     return True
 
 
+def zipEntryInfo(file_name: str) -> zipfile.ZipInfo:
+    """固定时间戳与属性的条目头, 保证归档逐字节可复现"""
+    zinfo = zipfile.ZipInfo(file_name, date_time=(1980, 1, 1, 0, 0, 0))
+    zinfo.external_attr = 0o100644 << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+def writeZipEntry(zipf: zipfile.ZipFile, file_name: str, file_data: IO[bytes]):
+    """以固定时间戳与属性写入一个条目, 并关闭 file_data"""
+    start = metrics.clock()
+    with file_data:
+        data = file_data.read()
+        zipf.writestr(zipEntryInfo(file_name), data)
+    metrics.phase('zip_write', start)
+    metrics.inc('hitomi_zip_bytes_total', len(data))
+
+
+def deflateEntry(file_data: IO[bytes]) -> tuple[bytes, bytes]:
+    """
+    读取并关闭 file_data, 返回 (原始数据, 压缩结果)
+    参数与 zipfile 对 ZIP_DEFLATED 条目使用的完全相同: 默认压缩级别, 不带 zlib 头的 raw deflate
+    """
+    start = metrics.clock()
+    with file_data:
+        data = file_data.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    metrics.phase('zip_deflate', start)
+    return data, compressed
+
+
+class PrecompressedDeflate:
+    """冒充 zipfile 的压缩器, 交出已经在线程池中算好的压缩结果"""
+
+    def __init__(self, compressed: bytes):
+        self.compressed = compressed
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressed
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def writeDeflatedEntry(zipf: zipfile.ZipFile, file_name: str, data: bytes, compressed: bytes):
+    """
+    写入已压缩好的条目, 结果与 writeZipEntry 逐字节一致
+    头部、CRC、偏移与 ZIP64 判断仍由 zipfile 自己完成, 只替换其压缩器; 与 writestr 一样只调用一次 write
+    """
+    start = metrics.clock()
+    zinfo = zipEntryInfo(file_name)
+    zinfo.file_size = len(data)
+    with zipf.open(zinfo, mode='w') as dest:
+        dest._compressor = PrecompressedDeflate(compressed)
+        dest.write(data)
+    metrics.phase('zip_write', start)
+    metrics.inc('hitomi_zip_bytes_total', len(data))
+
+
+def checkDeflatedEntry() -> bool:
+    """
+    writeDeflatedEntry 依赖 zipfile 的内部实现 (_ZipWriteFile._compressor),
+    在内存中分别用它与 writeZipEntry 打包同一组样本, 比较两者的 SHA-256 是否一致
+    """
+    samples = [('empty', b''), ('text', b'hitomi ' * 4096), ('random', random.Random(0).randbytes(64 * 1024))]
+    digests = []
+    try:
+        for parallel in (False, True):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as zipf:
+                for name, sample in samples:
+                    if parallel:
+                        writeDeflatedEntry(zipf, name, *deflateEntry(io.BytesIO(sample)))
+                    else:
+                        writeZipEntry(zipf, name, io.BytesIO(sample))
+            digests.append(hashlib.sha256(buffer.getvalue()).digest())
+    except Exception as e:
+        logger.warning(f'并行压缩自检出错: {type(e)}:{e}')
+        return False
+    return digests[0] == digests[1]
+
+
+zip_executor: Optional[ThreadPoolExecutor] = None
+zip_workers = 0
+# None 表示尚未自检
+zip_parallel_ok: Optional[bool] = None
+
+
+def setZipWorkers(workers: Optional[int] = None):
+    """设置并行压缩的线程数, 默认为 CPU 核数; ParallelZipWriter 的默认窗口随之调整"""
+    global zip_executor, zip_workers
+    if zip_executor is not None:
+        zip_executor.shutdown(wait=False)
+    zip_workers = workers or os.cpu_count() or 1
+    zip_executor = ThreadPoolExecutor(max_workers=zip_workers, thread_name_prefix='deflate')
+
+
+class ParallelZipWriter:
+    """
+    多核压缩的确定性 ZIP 写入器
+    条目在线程池中压缩 (zlib 压缩时释放 GIL), 再按加入顺序写出, 输出与逐个 writeZipEntry 完全一致;
+    最多同时持有 window (默认为压缩线程数的两倍) 个尚未写出的条目, 内存占用与画廊页数无关.
+    首次使用时运行 checkDeflatedEntry, 结果不一致 (zipfile 内部实现变化) 时退回逐个 writeZipEntry
+    """
+
+    def __init__(self, zipf: zipfile.ZipFile, window: Optional[int] = None):
+        global zip_parallel_ok
+        if zip_executor is None:
+            setZipWorkers()
+        if zip_parallel_ok is None:
+            zip_parallel_ok = checkDeflatedEntry()
+            if not zip_parallel_ok:
+                logger.warning('并行压缩的输出与 writeZipEntry 不一致, 退回串行写入')
+        self.zipf = zipf
+        self.executor = zip_executor
+        self.parallel = zip_parallel_ok
+        self.window = window or zip_workers * 2
+        self._pending: deque[tuple[str, asyncio.Future]] = deque()
+
+    async def add(self, file_name: str, file_data: IO[bytes]):
+        """提交压缩并接管 file_data; 待写条目超过 window 时先写出最早的一个"""
+        if not self.parallel:
+            await asyncio.to_thread(writeZipEntry, self.zipf, file_name, file_data)
+            return
+        future = asyncio.get_running_loop().run_in_executor(self.executor, deflateEntry, file_data)
+        self._pending.append((file_name, future))
+        if len(self._pending) > self.window:
+            await self._writeOldest()
+
+    async def finish(self):
+        while self._pending:
+            await self._writeOldest()
+
+    async def _writeOldest(self):
+        file_name, future = self._pending.popleft()
+        data, compressed = await future
+        await asyncio.to_thread(writeDeflatedEntry, self.zipf, file_name, data, compressed)
+
+
+class BatchReport(BaseModel):
+    galleries: int = 0
+    failed: list[int] = Field(default_factory=list)
+    pages: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def galleries_per_min(self) -> float:
+        return self.galleries / self.seconds * 60 if self.seconds else 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.bytes / 1024 ** 2 / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        text = (f'完成 {self.galleries} 个画廊 / {self.pages} 页 / {self.bytes / 1024 ** 2:.1f} MB, '
+                f'耗时 {self.seconds:.1f}s, {self.galleries_per_min:.2f} 画廊/分钟, {self.mb_per_s:.2f} MB/s')
+        if self.failed:
+            text += f', 失败: {self.failed}'
+        return text
+
+
+async def batchDownload(comic_ids: list[int],
+                        output_dir: str | Path = '.',
+                        jobs: int = 3,
+                        concurrency: int = 20,
+                        host_limit: Optional[int] = None,
+                        prefetch: Optional[int] = None,
+                        session: Optional[HitomiSession] = None,
+                        resume_dir: Optional[str | Path] = None) -> BatchReport:
+    """
+    多画廊批量下载
+    jobs 个画廊同时下载, 所有页面请求共享 concurrency 的全局并发预算, 每个图片域名最多 host_limit 个并发;
+    后续画廊的元数据在当前画廊下载期间提前获取 (最多领先 prefetch 个)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    prefetch = prefetch or jobs * 2
+    limiter = PageLimiter(concurrency, host_limit)
+    report = BatchReport()
+    start = time.monotonic()
+    pending_ids: asyncio.Queue[int] = asyncio.Queue()
+    for comic_id in comic_ids:
+        pending_ids.put_nowait(comic_id)
+    comics: asyncio.Queue[Optional[tuple[int, Optional[Comic]]]] = asyncio.Queue(maxsize=prefetch)
+    pbar = tqdm(total=0, desc="Downloading", unit="file")
+
+    # noinspection PyUnusedLocal
+    async def page_done(dl_url: str):
+        report.pages += 1
+        pbar.update(1)
+
+    async def fetch_metadata(_session: HitomiSession):
+        while not pending_ids.empty():
+            comic_id = pending_ids.get_nowait()
+            try:
+                comic = await getComic(comic_id, _session)
+            except Exception as e:
+                logger.error(f'{comic_id} 元数据获取失败: {type(e)}:{e}')
+                comic = None
+            await comics.put((comic_id, comic))
+
+    async def download_worker(_session: HitomiSession):
+        while (item := await comics.get()) is not None:
+            comic_id, comic = item
+            if comic is None:
+                report.failed.append(comic_id)
+                continue
+            pbar.total += len(comic.files)
+            pbar.refresh()
+            archive_path = output_dir / f'{comic_id}.zip'
+            try:
+                with open(archive_path, 'wb') as f:
+                    await downloadComic(comic, f, phase_callback=page_done, session=_session,
+                                        resume_dir=resume_dir, limiter=limiter)
+                report.galleries += 1
+                report.bytes += archive_path.stat().st_size
+            except Exception as e:
+                logger.error(f'{comic_id} 下载失败: {type(e)}:{e}')
+                report.failed.append(comic_id)
+                # 不完整的归档与下载完成的无法区分, 直接删除
+                archive_path.unlink(missing_ok=True)
+
+    async with useSession(session, image_limits=httpx.Limits(max_keepalive_connections=concurrency,
+                                                             max_connections=concurrency)) as session:
+        fetchers = [asyncio.ensure_future(fetch_metadata(session)) for _ in range(min(prefetch, len(comic_ids)) or 1)]
+        workers = [asyncio.ensure_future(download_worker(session)) for _ in range(jobs)]
+        try:
+            await asyncio.gather(*fetchers)
+            for _ in workers:
+                await comics.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in fetchers + workers:
+                task.cancel()
+            pbar.close()
+    report.seconds = time.monotonic() - start
+    return report
+
+
 import struct
 import hashlib
 
@@ -390,17 +1597,190 @@ import hashlib
 B = 16
 
 
-async def get_bytes(client: httpx.AsyncClient, url: str, start: int, length: int) -> bytes:
-    """基于 robustGet 的 Range 请求封装"""
+class IndexMirror:
+    """
+    galleriesindex 与部分 nozomi 文件的本地镜像
+    文件以 mmap 只读打开, 读取返回 memoryview 切片, 不产生拷贝
+    索引文件名自带版本号, 版本变化后自然不再命中; nozomi 超过 nozomi_max_age 视为过期
+    未命中或过期时返回 None, 由调用方回退到远程 Range 请求
+    """
+
+    def __init__(self, root: str | Path, nozomi_max_age: float = 3600):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.nozomi_max_age = nozomi_max_age
+        self.manifest_path = self.root / 'manifest.json'
+        self.manifest: dict[str, dict[str, float]] = {}
+        if self.manifest_path.is_file():
+            self.manifest = json.loads(self.manifest_path.read_text(encoding='utf-8'))
+        self._maps: dict[str, mmap.mmap] = {}
+
+    def _fresh(self, rel_path: str) -> bool:
+        entry = self.manifest.get(rel_path)
+        if entry is None:
+            return False
+        if rel_path.endswith(nozomiextension):
+            return time.time() - entry['synced_at'] < self.nozomi_max_age
+        return True
+
+    def view(self, rel_path: str) -> Optional[memoryview]:
+        """整个文件的只读视图"""
+        if not self._fresh(rel_path):
+            return None
+        mapped = self._maps.get(rel_path)
+        if mapped is None:
+            file_path = self.root / rel_path
+            if not file_path.is_file():
+                return None
+            if file_path.stat().st_size == 0:
+                return memoryview(b'')
+            with open(file_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[rel_path] = mapped
+        return memoryview(mapped)
+
+    def read(self, rel_path: str, start: int, length: int) -> Optional[memoryview]:
+        full = self.view(rel_path)
+        if full is None:
+            return None
+        return full[start:start + length]
+
+    async def sync(self, session: HitomiSession, nozomi_subpaths: list[str] = ()):
+        """下载当前版本的 .index/.data 与指定的 nozomi 文件, 并删除旧版本的索引"""
+        version = index_versions[galleries_index_dir]
+        if not version:
+            raise ValueError('请先调用 refreshVersion')
+        targets = [f'{galleries_index_dir}/galleries.{version}.index',
+                   f'{galleries_index_dir}/galleries.{version}.data']
+        targets += [f'{subpath}{nozomiextension}' for subpath in nozomi_subpaths]
+        for rel_path in targets:
+            if self._fresh(rel_path):
+                continue
+            logger.info(f'同步镜像: {rel_path}')
+            file_path = self.root / rel_path
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            part_path = file_path.with_name(file_path.name + '.part')
+            with open(part_path, 'w+b') as f:
+                status = await robustDownload(session.ltn, f'https://{domain}/{rel_path}', f,
+                                              header={'Referer': 'https://hitomi.la/'})
+            if status is None:
+                part_path.unlink(missing_ok=True)
+                logger.error(f'同步镜像失败: {rel_path}')
+                continue
+            # 旧文件可能仍被 mmap 引用, 改名替换不影响已有的视图
+            self._maps.pop(rel_path, None)
+            os.replace(part_path, file_path)
+            self.manifest[rel_path] = {'synced_at': time.time(), 'size': file_path.stat().st_size}
+        for rel_path in list(self.manifest):
+            if rel_path.startswith(f'{galleries_index_dir}/') and f'.{version}.' not in rel_path:
+                self._maps.pop(rel_path, None)
+                (self.root / rel_path).unlink(missing_ok=True)
+                del self.manifest[rel_path]
+        self.manifest_path.write_text(json.dumps(self.manifest), encoding='utf-8')
+
+
+index_mirror: Optional[IndexMirror] = None
+
+
+def setIndexMirror(root: Optional[str | Path], nozomi_max_age: float = 3600):
+    """启用 (或传入 None 关闭) 本地索引镜像"""
+    global index_mirror
+    index_mirror = IndexMirror(root, nozomi_max_age) if root is not None else None
+
+
+class SingleFlight:
+    """
+    并发去重: 相同 key 的并发调用共享同一个进行中的任务及其结果
+    任务结束即从表中移除, 不承担缓存职责; 单个调用方被取消不会影响共享的任务
+    """
+
+    def __init__(self):
+        self._tasks: dict[Any, asyncio.Task] = {}
+
+    async def do(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            metrics.inc('hitomi_singleflight_shared_total', kind=key[0])
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Any, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # 没有调用方等待时也要取走异常, 避免 "exception was never retrieved"
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+
+inflight = SingleFlight()
+
+
+async def get_bytes(client: httpx.AsyncClient, url: str, start: int, length: int) -> bytes | memoryview:
+    """基于 robustGet 的 Range 请求封装, 本地镜像命中时直接返回镜像中的切片, 相同区间的并发请求只发一次"""
+    if index_mirror is not None:
+        local = index_mirror.read(url, start, length)
+        if local is not None:
+            metrics.inc('hitomi_mirror_bytes_total', len(local), file=url.rsplit('.', 1)[-1])
+            return local
+    return await inflight.do(('bytes', url, start, length), lambda: fetch_bytes(client, url, start, length))
+
+
+async def fetch_bytes(client: httpx.AsyncClient, url: str, start: int, length: int) -> bytes:
     end = start + length - 1
     headers = {'Range': f'bytes={start}-{end}', 'Referer': 'https://hitomi.la/'}
-    logger.debug(f'正在向 {url} 请求 {start} 到 {end} 的数据')
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'正在向 {url} 请求 {start} 到 {end} 的数据')
     resp = await robustGet(client, f"https://{domain}/{url}", header=headers)
     if resp and resp.status_code in [200, 206]:
+        metrics.inc('hitomi_index_bytes_total', len(resp.content), file=url.rsplit('.', 1)[-1])
         return resp.content
     return b''
 
 
+# 合并 Range 请求: 间隔不超过 RANGE_COALESCE_GAP 的区间合并为一次请求, 单次请求不超过 RANGE_COALESCE_MAX
+# 同一轮的请求本就在 HTTP/2 上并发, 合并只为省去逐个请求的开销, 因此间隔阈值不宜过大
+RANGE_COALESCE_GAP = 8 * 1024
+RANGE_COALESCE_MAX = 1024 * 1024
+
+
+async def get_bytes_many(client: httpx.AsyncClient, url: str,
+                         ranges: list[tuple[int, int]]) -> list[Optional[bytes | memoryview]]:
+    """
+    批量读取同一文件的多个 (start, length) 区间, 相邻区间合并为一次 Range 请求, 结果与 ranges 一一对应
+    读取失败 (重试耗尽或区间超出文件) 的区间为 None, 与读到的空数据区分开
+    """
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    groups: list[tuple[int, int, list[int]]] = []
+    for i in order:
+        start, length = ranges[i]
+        if groups:
+            g_start, g_end, members = groups[-1]
+            if start - g_end <= RANGE_COALESCE_GAP and max(g_end, start + length) - g_start <= RANGE_COALESCE_MAX:
+                groups[-1] = (g_start, max(g_end, start + length), members + [i])
+                continue
+        groups.append((start, start + length, [i]))
+    if len(groups) < len(ranges):
+        if logger.isEnabledFor(DEBUG_LEVEL):
+            logger.debug(f'{url}: {len(ranges)} 个区间合并为 {len(groups)} 次请求')
+    blobs = await asyncio.gather(*[get_bytes(client, url, g_start, g_end - g_start) for g_start, g_end, _ in groups])
+    results: list[Optional[bytes | memoryview]] = [None] * len(ranges)
+    for (g_start, _, members), blob in zip(groups, blobs):
+        if not blob:
+            continue
+        view = memoryview(blob)
+        for i in members:
+            start, length = ranges[i]
+            results[i] = view[start - g_start:start - g_start + length]
+    return results
+
+
 def hash_term(term: str) -> bytes:
     """计算搜索词的 SHA-256 哈希（前4字节）"""
     sha = hashlib.sha256()
@@ -446,115 +1826,599 @@ class BTreeNode:
             self.subnode_addrs.append(addr)
 
 
-async def b_search_recursive(client: httpx.AsyncClient, key: bytes, node_addr: int = 0) -> Optional[tuple[int, int]]:
-    """递归遍历远程 B-Tree"""
+class BTreeNodeCache:
+    """
+    按索引版本与节点地址缓存 BTreeNode 的 LRU
+    内存中最多保留 max_nodes 个节点, 设置 cache_dir 后原始节点数据还会落盘, 跨进程复用
+    索引版本变化时自动丢弃旧版本的全部节点
+    """
+
+    def __init__(self, max_nodes: int = 4096, cache_dir: Optional[Path] = None):
+        self.max_nodes = max_nodes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.version = ''
+        self._nodes: OrderedDict[tuple[str, int], BTreeNode] = OrderedDict()
+
+    def _nodePath(self, version: str, node_addr: int) -> Path:
+        return self.cache_dir / version / f'{node_addr}.node'
+
+    def get(self, version: str, node_addr: int) -> Optional[BTreeNode]:
+        key = (version, node_addr)
+        node = self._nodes.get(key)
+        if node is not None:
+            self._nodes.move_to_end(key)
+            return node
+        if self.cache_dir is None:
+            return None
+        node_path = self._nodePath(version, node_addr)
+        if not node_path.is_file():
+            return None
+        node = BTreeNode(node_path.read_bytes())
+        self._remember(key, node)
+        return node
+
+    def put(self, version: str, node_addr: int, node: BTreeNode, raw_data: bytes):
+        self._remember((version, node_addr), node)
+        if self.cache_dir is None:
+            return
+        node_path = self._nodePath(version, node_addr)
+        try:
+            node_path.parent.mkdir(parents=True, exist_ok=True)
+            node_path.write_bytes(raw_data)
+        except OSError as e:
+            logger.warning(f'B树节点缓存写入失败: {type(e)}:{e}')
+
+    def _remember(self, key: tuple[str, int], node: BTreeNode):
+        self._nodes[key] = node
+        self._nodes.move_to_end(key)
+        while len(self._nodes) > self.max_nodes:
+            self._nodes.popitem(last=False)
+
+    def invalidate(self, version: str):
+        """切换到新版本, 丢弃其余版本的内存与磁盘缓存"""
+        if version == self.version:
+            return
+        logger.debug(f'B树缓存版本切换: {self.version} -> {version}')
+        self.version = version
+        for key in [k for k in self._nodes if k[0] != version]:
+            del self._nodes[key]
+        if self.cache_dir is None or not self.cache_dir.is_dir():
+            return
+        for version_dir in self.cache_dir.iterdir():
+            if version_dir.is_dir() and version_dir.name != version:
+                shutil.rmtree(version_dir, ignore_errors=True)
+
+
+btree_cache = BTreeNodeCache()
+
+
+def setBTreeCache(max_nodes: int = 4096, cache_dir: Optional[str | Path] = None):
+    """重新配置 B 树节点缓存, cache_dir 为 None 时仅使用内存"""
+    global btree_cache
+    btree_cache = BTreeNodeCache(max_nodes, Path(cache_dir) if cache_dir else None)
+    btree_cache.invalidate(index_versions[galleries_index_dir])
+
+
+async def get_btree_node(client: httpx.AsyncClient, node_addr: int) -> Optional[BTreeNode]:
+    """读取 B 树节点, 优先命中缓存"""
     version = index_versions[galleries_index_dir]
+    node = btree_cache.get(version, node_addr)
+    if node is not None:
+        metrics.inc('hitomi_btree_nodes_total', source='cache')
+        return node
     index_url = f"{galleries_index_dir}/galleries.{version}.index"
-    logger.debug(f'对 key: {key} node_addr: {node_addr} 执行b树搜索')
     # 读取节点头 (4KB 通常足够包含一个节点)
     node_data = await get_bytes(client, index_url, node_addr, 4096)
     if not node_data:
         return None
+    metrics.inc('hitomi_btree_nodes_total', source='remote')
+    start = metrics.clock()
     node = BTreeNode(node_data)
-    # 比较 Key
-    idx = 0
-    found = False
-    for i, k in enumerate(node.keys):
-        if key < k:
-            idx = i
-            break
-        elif key == k:
-            idx = i
-            found = True
-            break
-        else:
-            idx = i + 1
-    if found:
-        return node.datas[idx]
+    metrics.phase('btree_parse', start)
+    btree_cache.put(version, node_addr, node, node_data)
+    return node
+
+
+async def get_btree_nodes(client: httpx.AsyncClient, node_addrs: list[int]) -> dict[int, Optional[BTreeNode]]:
+    """批量读取 B 树节点, 未命中缓存的节点合并为尽量少的 Range 请求"""
+    version = index_versions[galleries_index_dir]
+    nodes: dict[int, Optional[BTreeNode]] = {}
+    misses = []
+    for node_addr in node_addrs:
+        nodes[node_addr] = btree_cache.get(version, node_addr)
+        if nodes[node_addr] is None:
+            misses.append(node_addr)
+    metrics.inc('hitomi_btree_nodes_total', len(node_addrs) - len(misses), source='cache')
+    if not misses:
+        return nodes
+    index_url = f"{galleries_index_dir}/galleries.{version}.index"
+    blobs = await get_bytes_many(client, index_url, [(node_addr, 4096) for node_addr in misses])
+    for node_addr, node_data in zip(misses, blobs):
+        if not node_data:
+            continue
+        metrics.inc('hitomi_btree_nodes_total', source='remote')
+        start = metrics.clock()
+        node = BTreeNode(node_data)
+        metrics.phase('btree_parse', start)
+        btree_cache.put(version, node_addr, node, node_data)
+        nodes[node_addr] = node
+    return nodes
+
+
+def btree_step(node: BTreeNode, key: bytes) -> tuple[Optional[tuple[int, int]], int]:
+    """在节点内查找 key, 返回 (命中的数据指针, 需要继续下探的子节点地址), 未命中且无子节点时地址为 0"""
+    # keys 有序, 第一个不小于 key 的位置即为命中位置或下探的分支
+    idx = bisect.bisect_left(node.keys, key)
+    if idx < len(node.keys) and node.keys[idx] == key:
+        return node.datas[idx], 0
     # 如果是叶子节点且没找到
     if all(addr == 0 for addr in node.subnode_addrs):
+        return None, 0
+    return None, node.subnode_addrs[idx]
+
+
+async def b_search_recursive(client: httpx.AsyncClient, key: bytes, node_addr: int = 0) -> Optional[tuple[int, int]]:
+    """递归遍历远程 B-Tree"""
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'对 key: {key} node_addr: {node_addr} 执行b树搜索')
+    node = await get_btree_node(client, node_addr)
+    if node is None:
         return None
-    sub_addr = node.subnode_addrs[idx]
-    if sub_addr == 0:
-        return None
+    data_ptr, sub_addr = btree_step(node, key)
+    if data_ptr is not None or sub_addr == 0:
+        return data_ptr
     return await b_search_recursive(client, key, sub_addr)
 
 
-async def get_ids_from_data(client: httpx.AsyncClient, offset: int, length: int) -> set[int]:
-    """从 .data 文件读取 ID 列表"""
-    logger.debug(f'正在获取 offset: {offset}, length: {length} 的数据')
+async def b_search_many(client: httpx.AsyncClient,
+                        keys: list[bytes]) -> tuple[dict[bytes, Optional[tuple[int, int]]], set[bytes]]:
+    """
+    多个 key 一起逐层下探 B 树
+    每层中相同的节点只读取一次, 不同节点的读取合并为尽量少的 Range 请求, 总往返次数约等于树高
+    返回 (命中的数据指针, 节点读取失败的 key); 不存在的 key 对应 None, 读取失败的 key 不在前者中
+    """
+    results: dict[bytes, Optional[tuple[int, int]]] = {}
+    failed: set[bytes] = set()
+    frontier: dict[int, list[bytes]] = {0: list(dict.fromkeys(keys))}
+    depth = 0
+    while frontier:
+        depth += 1
+        nodes = await get_btree_nodes(client, list(frontier))
+        next_frontier: dict[int, list[bytes]] = {}
+        for node_addr, node_keys in frontier.items():
+            node = nodes.get(node_addr)
+            for key in node_keys:
+                if node is None:
+                    failed.add(key)
+                    continue
+                data_ptr, sub_addr = btree_step(node, key)
+                if data_ptr is not None or sub_addr == 0:
+                    results[key] = data_ptr
+                else:
+                    next_frontier.setdefault(sub_addr, []).append(key)
+        frontier = next_frontier
+    metrics.observe('hitomi_btree_depth', depth, buckets=(1, 2, 3, 4, 5, 6, 8, 12))
+    return results, failed
+
+
+def empty_ids() -> np.ndarray:
+    return np.empty(0, dtype=np.int32)
+
+
+def decode_ids(raw: bytes, offset: int = 0, count: int = -1) -> np.ndarray:
+    """
+    一次性将大端 int32 数组解码为升序、去重的 ID 数组
+    nozomi 本身按新到旧排列, 翻转后即为升序, 只有在不满足时才额外排序
+    """
+    start = metrics.clock()
+    ids = np.frombuffer(raw, dtype='>i4', count=count, offset=offset)[::-1].astype(np.int32)
+    if ids.size > 1 and not bool(np.all(ids[1:] > ids[:-1])):
+        ids = np.unique(ids)
+    metrics.phase('decode', start)
+    metrics.inc('hitomi_decoded_ids_total', ids.size)
+    return ids
+
+
+def readonly_ids(ids: np.ndarray) -> np.ndarray:
+    """并发去重后同一个数组会交给多个调用方, 设为只读以防被原地修改"""
+    ids.flags.writeable = False
+    return ids
+
+
+def _contains_ids(haystack: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """对升序数组做二分归并, 返回 needles 中每个元素是否存在于 haystack 的掩码"""
+    if not haystack.size:
+        return np.zeros(needles.size, dtype=bool)
+    pos = np.searchsorted(haystack, needles)
+    pos[pos == haystack.size] = 0
+    return haystack[pos] == needles
+
+
+def intersect_ids(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    start = metrics.clock()
+    # 以较小的数组去大数组里二分, 代价为 O(m log n)
+    if a.size > b.size:
+        a, b = b, a
+    result = a[_contains_ids(b, a)]
+    metrics.phase('set_algebra', start, op='intersect')
+    return result
+
+
+def union_ids(id_arrays: list[np.ndarray]) -> np.ndarray:
+    if not id_arrays:
+        return empty_ids()
+    start = metrics.clock()
+    result = np.unique(np.concatenate(id_arrays))
+    metrics.phase('set_algebra', start, op='union')
+    return result
+
+
+def difference_ids(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    start = metrics.clock()
+    result = a[~_contains_ids(b, a)]
+    metrics.phase('set_algebra', start, op='difference')
+    return result
+
+
+async def get_ids_from_data(client: httpx.AsyncClient, offset: int, length: int) -> Optional[np.ndarray]:
+    """从 .data 文件读取 ID 列表, 读取失败返回 None"""
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'正在获取 offset: {offset}, length: {length} 的数据')
+    version = index_versions[galleries_index_dir]
+    data_url = f"{galleries_index_dir}/galleries.{version}.data"
+
+    async def fetch() -> Optional[np.ndarray]:
+        raw = await get_bytes(client, data_url, offset, length)
+        # 记录至少包含 4 字节的计数, 空数据只可能是读取失败
+        return readonly_ids(decode_data_record(raw)) if raw else None
+
+    return await inflight.do(('data', data_url, offset, length), fetch)
+
+
+async def get_ids_from_data_many(client: httpx.AsyncClient,
+                                 data_ptrs: list[tuple[int, int]]) -> list[Optional[np.ndarray]]:
+    """批量读取 .data 中的多条记录, 相邻记录合并为一次 Range 请求, 读取失败的记录为 None"""
     version = index_versions[galleries_index_dir]
     data_url = f"{galleries_index_dir}/galleries.{version}.data"
-    raw_data = await get_bytes(client, data_url, offset, length)
-    if not raw_data:
-        return set()
+    return [decode_data_record(raw) if raw else None for raw in await get_bytes_many(client, data_url, data_ptrs)]
+
+
+def decode_data_record(raw_data: bytes | memoryview) -> np.ndarray:
+    if len(raw_data) < 4:
+        return empty_ids()
     # 解析 int32 数组: [count, id1, id2, ...]
     count = struct.unpack('>i', raw_data[0:4])[0]
-    ids = set()
-    for i in range(count):
-        start = 4 + i * 4
-        gid = struct.unpack('>i', raw_data[start: start + 4])[0]
-        ids.add(gid)
-    return ids
+    return decode_ids(raw_data, offset=4, count=count)
 
 
-async def get_ids_from_nozomi(client: httpx.AsyncClient, subpath: str) -> set[int]:
-    """解析 .nozomi 文件 (纯 ID 列表)"""
-    logger.debug(f'对 {subpath} 发起 nozomi 请求')
+async def get_ids_from_nozomi(client: httpx.AsyncClient, subpath: str) -> Optional[np.ndarray]:
+    """解析 .nozomi 文件 (纯 ID 列表), 文件不存在返回空数组, 读取失败返回 None"""
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'对 {subpath} 发起 nozomi 请求')
     url = f"{subpath}.nozomi"
+    if index_mirror is not None:
+        local = index_mirror.view(url)
+        if local is not None:
+            return decode_ids(local, count=len(local) // 4)
+    return await inflight.do(('nozomi', url), lambda: fetch_nozomi(client, url))
+
+
+async def fetch_nozomi(client: httpx.AsyncClient, url: str) -> Optional[np.ndarray]:
     # 请求头中需要设置正确的 Referer，否则可能 403
     headers = {'Referer': 'https://hitomi.la/'}
-    resp = await robustGet(client, f"https://{domain}/{url}", header=headers)
-    if not resp or resp.status_code != 200:
-        return set()
+    resp = await robustGet(client, f"https://{domain}/{url}", header=headers, return_status=(404,))
+    if resp is None:
+        return None
+    if resp.status_code == 404:
+        return readonly_ids(empty_ids())
     data = resp.content
-    total_ids = len(data) // 4
-    ids = set()
-    for i in range(total_ids):
-        gid = struct.unpack('>i', data[i * 4: (i + 1) * 4])[0]
-        ids.add(gid)
-    return ids
+    metrics.inc('hitomi_index_bytes_total', len(data), file='nozomi')
+    return readonly_ids(decode_ids(data, count=len(data) // 4))
 
 
 # ================= 搜索逻辑 =================
 
-async def search_single_term(client: httpx.AsyncClient, term: str) -> set[int]:
+def nozomi_subpath(term: str) -> Optional[str]:
+    """命名空间 Tag 对应的 nozomi 路径 (不含扩展名), 普通文本返回 None"""
+    if ':' not in term:
+        return None
+    left, right = term.split(':', 1)
+    # 根据 search.js 的 nozomi 映射规则
+    if left in ['female', 'male']:
+        return f"tag/{left}-{right}-all"
+    elif left == 'language':
+        return f"index-{right}"
+    elif left in ['artist', 'character', 'series', 'group']:
+        return f"{left}/{right}-all"
+    elif left == 'type':  # e.g. type:manga
+        return f"type/{right}-all"
+    return None
+
+
+async def search_single_term(client: httpx.AsyncClient, term: str) -> np.ndarray:
     """处理单个搜索词（包含 Tag 映射逻辑）"""
     term = term.replace('_', ' ')
     # 1. 处理命名空间 Tag (例如: female:big_breasts)
-    if ':' in term:
+    subpath = nozomi_subpath(term)
+    if subpath is not None:
         logger.debug(f'处理命名空间 Tag: {term}')
-        left, right = term.split(':', 1)
-        # 根据 search.js 的 nozomi 映射规则
-        if left in ['female', 'male']:
-            return await get_ids_from_nozomi(client, f"tag/{left}-{right}-all")
-        elif left == 'language':
-            return await get_ids_from_nozomi(client, f"index-{right}")
-        elif left in ['artist', 'character', 'series', 'group']:
-            return await get_ids_from_nozomi(client, f"{left}/{right}-all")
-        elif left == 'type':  # e.g. type:manga
-            return await get_ids_from_nozomi(client, f"type/{right}-all")
+        ids = await get_ids_from_nozomi(client, subpath)
+        return ids if ids is not None else empty_ids()
     # 2. 普通文本搜索 (B-Tree)
     logger.debug(f'处理单词: {term}')
     key = hash_term(term)
     data_ptr = await b_search_recursive(client, key, 0)
     if data_ptr:
         offset, length = data_ptr
-        return await get_ids_from_data(client, offset, length)
+        ids = await get_ids_from_data(client, offset, length)
+        return ids if ids is not None else empty_ids()
     logger.debug(f'单词 {term} 未检索到任何结果')
-    return set()
+    return empty_ids()
+
+
+# ================= 查询规划 =================
+
+# 候选集规模不足待取词估计规模的 1/PLAN_SLICE_RATIO 时, 才考虑只读取 nozomi 中覆盖候选 ID 的片段
+PLAN_SLICE_RATIO = 16
+# 片段相对整个文件至少要省下这么多字节, 才值得多付几轮探测请求
+PLAN_SLICE_MIN_SAVING = 256 * 1024
+# 边界探测: 每轮并发探测的点数, 以及剩余区间小于多少个 ID 时停止探测
+PLAN_PROBE_FANOUT = 8
+PLAN_PROBE_STOP = 4096
 
 
-async def searchIDs(query: str, max_threads: int = 5) -> list[int]:
+class TermPlan:
+    """单个搜索词的执行计划: 数据来源与基数估计"""
+    __slots__ = ('term', 'subpath', 'data_ptr', 'estimate', 'first_id', 'ids', 'failed')
+
+    def __init__(self, term: str, subpath: Optional[str] = None,
+                 data_ptr: Optional[tuple[int, int]] = None,
+                 estimate: int = -1, first_id: Optional[int] = None, failed: bool = False):
+        self.term = term
+        # nozomi 词: subpath 有值; B 树词: data_ptr 有值 (未命中时两者皆空)
+        self.subpath = subpath
+        self.data_ptr = data_ptr
+        # 估计的 ID 数量, -1 表示未估计
+        self.estimate = estimate
+        # nozomi 中的第一个 (最新的) ID
+        self.first_id = first_id
+        # 已经预先取回的结果
+        self.ids: Optional[np.ndarray] = None
+        # 索引读取失败: 基数与结果都未知, 不能当作空集
+        self.failed = failed
+
+    def __repr__(self):
+        return f'TermPlan({self.term!r}, estimate={self.estimate})'
+
+
+def check_plans(plans: list[TermPlan]):
+    """任一词的索引读取失败时抛出 ConnectionError, 缺失的倒排表不能当作空集参与求交或排除"""
+    failed = [plan.term for plan in plans if plan.failed]
+    if failed:
+        raise ConnectionError(f'索引读取失败: {failed}')
+
+
+def cached_plan(term: str, subpath: Optional[str], ids: np.ndarray) -> TermPlan:
+    """由缓存的倒排表直接构造计划, 基数即为精确值"""
+    count, first_id = nozomi_fingerprint(ids)
+    plan = TermPlan(term, subpath=subpath, estimate=count, first_id=first_id)
+    plan.ids = ids
+    return plan
+
+
+async def get_nozomi_head(client: httpx.AsyncClient, subpath: str) -> Optional[tuple[int, Optional[int]]]:
     """
-        主搜索入口 (全并行优化版)
-        """
-    logger.info(f"搜索: {query}")
+    只请求 nozomi 的前 4 字节, 从 Content-Range 得到文件总长度, 顺带拿到最新的 ID
+    文件不存在或为空时返回 (0, None), 请求失败返回 None
+    """
+    if index_mirror is not None:
+        local = index_mirror.view(f"{subpath}.nozomi")
+        if local is not None:
+            return len(local), struct.unpack('>i', local[:4])[0] if len(local) >= 4 else None
+    return await inflight.do(('nozomi-head', subpath), lambda: fetch_nozomi_head(client, subpath))
+
+
+async def fetch_nozomi_head(client: httpx.AsyncClient, subpath: str) -> Optional[tuple[int, Optional[int]]]:
+    headers = {'Range': 'bytes=0-3', 'Referer': 'https://hitomi.la/'}
+    # 404: 文件不存在; 416: 空文件. 两者都是确定的 0, 与重试耗尽区分开
+    resp = await robustGet(client, f"https://{domain}/{subpath}.nozomi", header=headers, return_status=(404, 416))
+    if resp is None:
+        return None
+    if resp.status_code in (404, 416):
+        return 0, None
+    content_range = resp.headers.get('Content-Range', '')
+    if resp.status_code == 206 and '/' in content_range:
+        total = int(content_range.rsplit('/', 1)[1])
+    else:
+        # 服务器忽略了 Range, 已经拿到整个文件
+        total = len(resp.content)
+    first_id = struct.unpack('>i', resp.content[:4])[0] if len(resp.content) >= 4 else None
+    return total, first_id
+
+
+async def plan_term(client: httpx.AsyncClient, term: str, estimate: bool = True) -> TermPlan:
+    """
+    在下载倒排表之前估计搜索词的基数
+    nozomi 词通过一次 4 字节的 Range 请求得到文件长度, B 树词直接使用 .data 中的记录长度
+    """
+    term = term.replace('_', ' ')
+    subpath = nozomi_subpath(term)
+    cached = search_cache.getTerm(term)
+    if cached is not None:
+        return cached_plan(term, subpath, cached)
+    if subpath is not None:
+        if not estimate:
+            return TermPlan(term, subpath=subpath)
+        head = await get_nozomi_head(client, subpath)
+        if head is None:
+            # 基数未知, 不能当作 0, 也不能用 (0, None) 去确认缓存
+            return TermPlan(term, subpath=subpath, failed=True)
+        total, first_id = head
+        plan = TermPlan(term, subpath=subpath, estimate=total // 4, first_id=first_id)
+        # 缓存的倒排表已过期, 但头部没有变化时仍可继续使用
+        plan.ids = search_cache.revalidateTerm(term, subpath, (plan.estimate, first_id))
+        return plan
+    key = hash_term(term)
+    data_ptrs, failed = await b_search_many(client, [key])
+    data_ptr = data_ptrs.get(key)
+    if not data_ptr:
+        if key in failed:
+            return TermPlan(term, failed=True)
+        return TermPlan(term, estimate=0)
+    # 记录格式为 [count, id1, id2, ...]
+    return TermPlan(term, data_ptr=data_ptr, estimate=max(data_ptr[1] // 4 - 1, 0))
+
+
+async def plan_terms(client: httpx.AsyncClient, terms: list[str]) -> list[TermPlan]:
+    """批量估计多个词的基数, 所有 B 树词一起下探"""
+    terms = [term.replace('_', ' ') for term in terms]
+    # 已缓存的词交给 plan_term 直接返回, 不参与下探
+    btree_terms = [term for term in terms if nozomi_subpath(term) is None and search_cache.getTerm(term) is None]
+
+    async def descend() -> tuple[dict[bytes, Optional[tuple[int, int]]], set[bytes]]:
+        if not btree_terms:
+            return {}, set()
+        return await b_search_many(client, [hash_term(term) for term in btree_terms])
+
+    (data_ptrs, failed), nozomi_plans = await asyncio.gather(
+        descend(),
+        asyncio.gather(*[plan_term(client, term) for term in terms if term not in btree_terms])
+    )
+    nozomi_plans = iter(nozomi_plans)
+    plans = []
+    for term in terms:
+        if term not in btree_terms:
+            plans.append(next(nozomi_plans))
+            continue
+        data_ptr = data_ptrs.get(hash_term(term))
+        if hash_term(term) in failed:
+            plans.append(TermPlan(term, failed=True))
+        elif not data_ptr:
+            plans.append(TermPlan(term, estimate=0))
+        else:
+            plans.append(TermPlan(term, data_ptr=data_ptr, estimate=max(data_ptr[1] // 4 - 1, 0)))
+    return plans
+
+
+async def prefetch_data(client: httpx.AsyncClient, plans: list[TermPlan]):
+    """一次性取回所有 B 树词的 ID 列表, 相邻记录合并请求"""
+    pending = [plan for plan in plans if plan.data_ptr is not None and plan.ids is None and plan.estimate != 0]
+    if not pending:
+        return
+    for plan, ids in zip(pending, await get_ids_from_data_many(client, [plan.data_ptr for plan in pending])):
+        if ids is None:
+            plan.ids, plan.failed = empty_ids(), True
+            continue
+        plan.ids = ids
+        search_cache.putTerm(plan, ids)
+
+
+async def search_terms(client: httpx.AsyncClient, terms: list[str]) -> list[np.ndarray]:
+    """批量版 search_single_term: B 树词一起下探并合并读取 .data, nozomi 词并行下载"""
+    plans = await plan_terms(client, terms)
+    check_plans(plans)
+    await prefetch_data(client, plans)
+    results = list(await asyncio.gather(*[fetch_term(client, plan) for plan in plans]))
+    check_plans(plans)
+    return results
+
+
+async def _nozomi_id_at(client: httpx.AsyncClient, url: str, index: int) -> Optional[int]:
+    raw = await get_bytes(client, url, index * 4, 4)
+    if len(raw) != 4:
+        return None
+    return struct.unpack('>i', raw)[0]
+
+
+async def _nozomi_bound(client: httpx.AsyncClient, url: str, count: int,
+                        predicate: Callable[[int], bool]) -> Optional[tuple[int, int]]:
+    """
+    在按新到旧排列的远程 nozomi 中做多路并发的二分查找
+    返回区间 [lo, hi], 第一个满足 predicate 的下标必定落在其中
+    """
+    lo, hi = 0, count
+    while hi - lo > PLAN_PROBE_STOP:
+        step = (hi - lo) / (PLAN_PROBE_FANOUT + 1)
+        points = sorted({lo + int(step * (k + 1)) for k in range(PLAN_PROBE_FANOUT)})
+        values = await asyncio.gather(*[_nozomi_id_at(client, url, point) for point in points])
+        if any(value is None for value in values):
+            return None
+        new_lo, new_hi = lo, hi
+        for point, value in zip(points, values):
+            if predicate(value):
+                new_hi = point
+                break
+            new_lo = point + 1
+        lo, hi = new_lo, new_hi
+    return lo, hi
+
+
+async def get_ids_from_nozomi_slice(client: httpx.AsyncClient, subpath: str, count: int,
+                                    min_id: int, max_id: int) -> Optional[np.ndarray]:
+    """只读取 nozomi 中覆盖 [min_id, max_id] 的片段, 失败返回 None"""
+    url = f"{subpath}.nozomi"
+    bounds = await asyncio.gather(
+        _nozomi_bound(client, url, count, lambda gid: gid <= max_id),
+        _nozomi_bound(client, url, count, lambda gid: gid < min_id)
+    )
+    if bounds[0] is None or bounds[1] is None:
+        return None
+    start, end = bounds[0][0], bounds[1][1]
+    if end <= start:
+        return empty_ids()
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'{subpath} 仅读取第 {start} 到 {end} 个 ID (共 {count} 个)')
+    raw = await get_bytes(client, url, start * 4, (end - start) * 4)
+    if len(raw) != (end - start) * 4:
+        return None
+    return decode_ids(raw)
+
+
+async def fetch_term(client: httpx.AsyncClient, plan: TermPlan,
+                     candidates: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    按计划获取搜索词的 ID
+    若已有远小于该词的候选集, 结果只需覆盖候选集的 ID 范围即可, 此时尽量只读取 nozomi 的片段
+    """
+    if plan.ids is not None:
+        return plan.ids
+    if plan.estimate == 0:
+        return empty_ids()
+    if plan.data_ptr is not None:
+        ids = await get_ids_from_data(client, *plan.data_ptr)
+        if ids is None:
+            plan.failed = True
+            return empty_ids()
+        search_cache.putTerm(plan, ids)
+        return ids
+    if plan.subpath is None:
+        return empty_ids()
+    if (candidates is not None and candidates.size and plan.first_id is not None
+            and plan.estimate > candidates.size * PLAN_SLICE_RATIO):
+        url = f"{plan.subpath}.nozomi"
+        last_id = await _nozomi_id_at(client, url, plan.estimate - 1)
+        if last_id is not None and plan.first_id > last_id:
+            # 假设 ID 在文件中大致均匀分布, 估计片段占整个文件的比例
+            min_id, max_id = int(candidates[0]), int(candidates[-1])
+            fraction = min((max_id - min_id + 1) / (plan.first_id - last_id + 1), 1.0)
+            if plan.estimate * 4 * (1 - fraction) >= PLAN_SLICE_MIN_SAVING:
+                ids = await get_ids_from_nozomi_slice(client, plan.subpath, plan.estimate, min_id, max_id)
+                if ids is not None:
+                    return ids
+    ids = await get_ids_from_nozomi(client, plan.subpath)
+    if ids is None:
+        plan.failed = True
+        return empty_ids()
+    search_cache.putTerm(plan, ids)
+    return ids
+
+
+def parse_query(query: str) -> tuple[list[str], list[list[str]], list[str]]:
+    """词法解析, 返回 (AND 词, OR 组, NOT 词)"""
     terms = query.lower().strip().split()
     positive_terms = []
     negative_terms = []
     or_groups = [[]]
-    # 1. 词法解析
     for i, term in enumerate(terms):
         if term == 'or':
             continue
@@ -570,87 +2434,865 @@ async def searchIDs(query: str, max_threads: int = 5) -> list[int]:
         else:
             positive_terms.append(term)
     or_groups = [g for g in or_groups if g]
-    # 注意：在并行模式下，"将带冒号的 term 提到最前" 的排序不再影响网络请求顺序，
-    # 但仍有助于后续集合运算时的某种微小确定性，故保留。
-    positive_terms.sort(key=lambda x: 0 if ':' in x else 1)
-    current_ids = set()
-    first_round = True
-    # ================= 执行搜索逻辑 (全并行化) =================
-    # 1. 构建所有并行任务 (Tasks Construction)
-    # 我们将 OR 组的处理、AND 词的处理、NOT 词的处理全部放入任务池
-    # 1.1 OR 组任务
-    # 每个 OR 组内部是并行的，组与组之间我们也希望并行获取数据
-    or_tasks = []
+    return positive_terms, or_groups, negative_terms
+
+
+async def execute_query(client: httpx.AsyncClient, positive_terms: list[str], or_groups: list[list[str]],
+                        negative_terms: list[str]) -> tuple[np.ndarray, list[TermPlan]]:
+    """
+    按代价规划并执行查询, 返回升序的结果与各个词的计划
+    先并行估计每个词的基数, 再从最有选择性的词开始逐步求交, 候选集足够小后只读取大倒排表的片段
+    任一词的索引读取失败时抛出 ConnectionError; 只有确认为空的词才会让查询提前结束或被跳过
+    """
+    # 1. 并行估计全部词的基数 (B 树词一起下探)
+    all_terms = list(dict.fromkeys(positive_terms + [t for g in or_groups for t in g] + negative_terms))
+    plans = dict(zip(all_terms, await plan_terms(client, all_terms)))
+    if logger.isEnabledFor(DEBUG_LEVEL):
+        logger.debug(f'查询计划: {list(plans.values())}')
+    check_plans(list(plans.values()))
+    # 每个 AND 词是一个单元, 每个 OR 组也是一个单元 (基数按组内之和估计)
+    units = [(plans[t].estimate, [plans[t]]) for t in positive_terms]
+    units += [(sum(plans[t].estimate for t in g), [plans[t] for t in g]) for g in or_groups]
+    units.sort(key=lambda unit: unit[0])
+    # 任何一个单元为空则交集必为空, 什么都不用下载
+    if units[0][0] == 0:
+        return empty_ids(), list(plans.values())
+    # B 树词的倒排表通常不大, 一次性合并读取
+    await prefetch_data(client, list(plans.values()))
+    check_plans(list(plans.values()))
+    # 2. 从最有选择性的单元开始求交
+    current_ids: Optional[np.ndarray] = None
+    for _, unit_plans in units:
+        results = await asyncio.gather(*[fetch_term(client, p, current_ids) for p in unit_plans])
+        check_plans(unit_plans)
+        unit_ids = results[0] if len(results) == 1 else union_ids(list(results))
+        current_ids = unit_ids if current_ids is None else intersect_ids(current_ids, unit_ids)
+        # 剪枝：如果已经为空，就没必要继续交集运算了
+        if not current_ids.size:
+            return empty_ids(), list(plans.values())
+    # 3. 处理 NOT 词 (负向筛选), 同样只需覆盖候选集
+    not_plans = [plans[t] for t in negative_terms if plans[t].estimate != 0]
+    not_results = await asyncio.gather(*[fetch_term(client, p, current_ids) for p in not_plans])
+    check_plans(not_plans)
+    for res in not_results:
+        current_ids = difference_ids(current_ids, res)
+    return current_ids, list(plans.values())
+
+
+async def searchIDs(query: str, max_threads: int = 5, session: Optional[HitomiSession] = None) -> list[int]:
+    """
+        主搜索入口 (基于代价的查询规划, 见 execute_query)
+        相同的查询 (规范化后) 以及查询中的单个词都会进入 search_cache
+        未传入 session 时以 max_threads 为连接数上限创建临时会话
+        """
+    logger.info(f"搜索: {query}")
+    positive_terms, or_groups, negative_terms = parse_query(query)
+    if not positive_terms and not or_groups:
+        # 只有排除词时逻辑上应该返回全集减去排除词, 但 Hitomi 默认行为通常是不给全集的
+        # 这里维持原逻辑：只在有结果时进行排除。
+        return []
     limits = httpx.Limits(max_keepalive_connections=max_threads, max_connections=max_threads)
-    async with httpx.AsyncClient(
-            proxy=proxy,
-            timeout=5,
-            limits=limits,
-            verify=False,  # 如果为了极致速度且信任环境，可关闭 verify (可选)
-            http2=True  # 如果服务器支持 HTTP/2，速度会起飞 (可选，需安装 httpx[http2])
-    ) as client:
-        for group in or_groups:
-            # 对每个组创建一个 gather 任务
-            or_tasks.append(asyncio.gather(*[search_single_term(client, t) for t in group]))
-        # 1.2 AND 词任务
-        and_tasks = [search_single_term(client, t) for t in positive_terms]
-        # 1.3 NOT 词任务
-        not_tasks = [search_single_term(client, t) for t in negative_terms]
-        # ================= 等待数据返回 (Await I/O) =================
-        # 这里我们分阶段 await，以便于逻辑处理，但 request 已经在此时可以并发发出
-        # 若追求极致，可以使用 asyncio.gather 将所有 task 一起发出，但这会使结果处理逻辑变得复杂
-        # 鉴于 or_groups 较少见，我们优先并行化 and_tasks
-        # A. 处理 OR 组 (如果存在)
-        if or_tasks:
-            # group_results_list 是一个列表，每个元素是该组内所有 term 的结果列表
-            group_results_list = await asyncio.gather(*or_tasks)
-            for group_results in group_results_list:
-                # 组内取并集 (Union)
-                group_union = set()
-                for res in group_results:
-                    group_union.update(res)
-                # 组间取交集 (Intersection)
-                if first_round:
-                    current_ids = group_union
-                    first_round = False
-                else:
-                    current_ids.intersection_update(group_union)
-        # B. 处理 AND 词 (正向筛选)
-        if and_tasks:
-            # === 关键修改：此处通过 gather 并行执行所有 AND 词的搜索 ===
-            and_results = await asyncio.gather(*and_tasks)
-            for res in and_results:
-                if first_round:
-                    current_ids = res
-                    first_round = False
-                else:
-                    # 剪枝：如果已经为空，就没必要继续交集运算了
-                    if not current_ids:
-                        break
-                    current_ids.intersection_update(res)
-        # C. 处理 NOT 词 (负向筛选)
-        if not_tasks and (current_ids or first_round):
-            # 注意：如果 current_ids 为空且 first_round 为 True (即只有排除词)，
-            # 逻辑上应该返回全集减去排除词。但 Hitomi 默认行为通常是不给全集的。
-            # 这里维持原逻辑：只在有结果时进行排除。
-            not_results = await asyncio.gather(*not_tasks)
-            for res in not_results:
-                if current_ids:
-                    current_ids.difference_update(res)
+    async with useSession(session, ltn_limits=limits, timeout=5) as session:
+        client = session.ltn
+        # 单个正向词无需规划, 直接取回 (倒排表本身会被缓存)
+        if len(positive_terms) == 1 and not or_groups and not negative_terms:
+            plan = await plan_term(client, positive_terms[0], estimate=False)
+            ids = await fetch_term(client, plan)
+            check_plans([plan])
+            return ids[::-1].tolist()
+        key = SearchCache.queryKey(positive_terms, or_groups, negative_terms)
+        current_ids = await search_cache.getResult(client, key)
+        if current_ids is not None:
+            logger.debug(f'搜索缓存命中: {key}')
+        else:
+            current_ids, plans = await execute_query(client, positive_terms, or_groups, negative_terms)
+            search_cache.putResult(key, current_ids, plans)
     # 排序结果 (ID 越大越新)
-    return sorted(list(current_ids), reverse=True)
+    return current_ids[::-1].tolist()
+
+
+# ================= 搜索缓存 =================
+
+def nozomi_fingerprint(ids: np.ndarray) -> tuple[int, Optional[int]]:
+    """nozomi 的指纹: (ID 数量, 最新的 ID), 与 get_nozomi_head 的结果可以直接比较"""
+    return int(ids.size), int(ids[-1]) if ids.size else None
+
+
+class SearchEntry:
+    """搜索缓存条目: ID 数组及其依赖的索引版本与 nozomi 指纹"""
+    __slots__ = ('ids', 'version', 'nozomi', 'fetched_at')
+
+    def __init__(self, ids: np.ndarray, version: Optional[str],
+                 nozomi: dict[str, tuple[int, Optional[int]]], fetched_at: float):
+        self.ids = ids
+        # 依赖 B 树时为当时的 galleriesindex 版本, 只依赖 nozomi 时为 None
+        self.version = version
+        self.nozomi = nozomi
+        self.fetched_at = fetched_at
+
+
+class SearchCache:
+    """
+    搜索缓存 (LRU, 按缓存的 ID 总数限制大小)
+    同时缓存整条查询的结果与单个词的倒排表, `a b` 与 `a c` 共享 `a` 的下载
+    依赖 B 树的条目绑定 galleriesindex 版本; nozomi 条目在 nozomi_max_age 秒内直接使用,
+    过期后用 4 字节的头部请求确认文件未变化 (ID 数量与最新 ID 均相同) 才继续使用
+    设置 path 后条目还会写入 SQLite, 跨进程复用
+    """
+
+    def __init__(self, max_ids: int = 16_000_000, nozomi_max_age: float = 600,
+                 path: Optional[str | Path] = None):
+        self.max_ids = max_ids
+        self.nozomi_max_age = nozomi_max_age
+        self.version = ''
+        self._entries: OrderedDict[str, SearchEntry] = OrderedDict()
+        self._size = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._conn = sqlite3.connect(Path(path))
+            self._conn.execute('CREATE TABLE IF NOT EXISTS search_cache ('
+                               'key TEXT PRIMARY KEY, version TEXT, nozomi TEXT NOT NULL, '
+                               'fetched_at REAL NOT NULL, ids BLOB NOT NULL)')
+            self._conn.commit()
+
+    @staticmethod
+    def queryKey(positive_terms: list[str], or_groups: list[list[str]], negative_terms: list[str]) -> str:
+        """规范化的查询: `_` 视为空格, 词排序去重, 只有一个词的 OR 组视为 AND 词"""
+        def normalize(terms: list[str]) -> set[str]:
+            return {term.replace('_', ' ') for term in terms}
+
+        groups = {tuple(sorted(normalize(g))) for g in or_groups}
+        positive = normalize(positive_terms) | {g[0] for g in groups if len(g) == 1}
+        groups = sorted(g for g in groups if len(g) > 1)
+        negative = sorted(normalize(negative_terms))
+        return 'query:' + json.dumps([sorted(positive), groups, negative], ensure_ascii=False)
+
+    def _load(self, key: str) -> Optional[SearchEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self._conn is not None:
+            row = self._conn.execute('SELECT version, nozomi, fetched_at, ids FROM search_cache WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return None
+            version, nozomi, fetched_at, raw = row
+            nozomi = {subpath: tuple(fingerprint) for subpath, fingerprint in json.loads(nozomi).items()}
+            ids = readonly_ids(np.frombuffer(raw, dtype='<i4').astype(np.int32))
+            entry = SearchEntry(ids, version, nozomi, fetched_at)
+            self._remember(key, entry)
+        if entry is not None and entry.version is not None and entry.version != self.version:
+            self._drop(key)
+            return None
+        return entry
+
+    def _expired(self, entry: SearchEntry) -> bool:
+        return bool(entry.nozomi) and time.time() - entry.fetched_at >= self.nozomi_max_age
+
+    def _touch(self, key: str, entry: SearchEntry):
+        entry.fetched_at = time.time()
+        if self._conn is not None:
+            self._conn.execute('UPDATE search_cache SET fetched_at = ? WHERE key = ?', (entry.fetched_at, key))
+            self._conn.commit()
+
+    def _remember(self, key: str, entry: SearchEntry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old.ids.size + 1
+        self._entries[key] = entry
+        self._size += entry.ids.size + 1
+        while self._size > self.max_ids and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.ids.size + 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.ids.size + 1
+        if self._conn is not None:
+            self._conn.execute('DELETE FROM search_cache WHERE key = ?', (key,))
+            self._conn.commit()
+
+    def put(self, key: str, ids: np.ndarray, version: Optional[str], nozomi: dict[str, tuple[int, Optional[int]]]):
+        if self.max_ids <= 0:
+            return
+        entry = SearchEntry(readonly_ids(ids), version, nozomi, time.time())
+        self._remember(key, entry)
+        if self._conn is None:
+            return
+        self._conn.execute('INSERT OR REPLACE INTO search_cache (key, version, nozomi, fetched_at, ids) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (key, version, json.dumps(nozomi), entry.fetched_at, ids.astype('<i4').tobytes()))
+        # 磁盘上同样按 ID 总数限制大小, 优先淘汰最久未确认的条目
+        self._conn.execute('DELETE FROM search_cache WHERE key IN (SELECT key FROM ('
+                           'SELECT key, SUM(LENGTH(ids) + 4) OVER (ORDER BY fetched_at DESC) AS total '
+                           'FROM search_cache) WHERE total > ?)', (self.max_ids * 4,))
+        self._conn.commit()
+
+    def getTerm(self, term: str) -> Optional[np.ndarray]:
+        """未过期的单个词的倒排表"""
+        entry = self._load(f'term:{term}')
+        if entry is None or self._expired(entry):
+            return None
+        return entry.ids
+
+    def revalidateTerm(self, term: str, subpath: str, fingerprint: tuple[int, Optional[int]]) -> Optional[np.ndarray]:
+        """已过期的 nozomi 词, 指纹与刚取得的头部一致时继续使用"""
+        key = f'term:{term}'
+        entry = self._load(key)
+        if entry is None or entry.nozomi.get(subpath) != fingerprint:
+            return None
+        self._touch(key, entry)
+        return entry.ids
+
+    def putTerm(self, plan: 'TermPlan', ids: np.ndarray):
+        """缓存完整取回的倒排表 (nozomi 片段不能缓存)"""
+        if plan.subpath is not None:
+            # 不存在的文件只需一次头部请求即可确认, 空数组不缓存
+            if ids.size:
+                self.put(f'term:{plan.term}', ids, None, {plan.subpath: nozomi_fingerprint(ids)})
+        else:
+            self.put(f'term:{plan.term}', ids, self.version, {})
+
+    async def getResult(self, client: httpx.AsyncClient, key: str) -> Optional[np.ndarray]:
+        entry = self._load(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            subpaths = list(entry.nozomi)
+            heads = await asyncio.gather(*[get_nozomi_head(client, subpath) for subpath in subpaths])
+            if any(head is None for head in heads):
+                # 无法确认文件未变化, 本次不使用缓存
+                return None
+            if any((total // 4, first_id) != entry.nozomi[subpath]
+                   for subpath, (total, first_id) in zip(subpaths, heads)):
+                logger.debug(f'搜索缓存已失效: {key}')
+                self._drop(key)
+                return None
+            self._touch(key, entry)
+        return entry.ids
+
+    def putResult(self, key: str, ids: np.ndarray, plans: list['TermPlan']):
+        # 任一词的索引读取失败, 结果可能不完整, 不缓存
+        if any(plan.failed for plan in plans):
+            return
+        # 规划阶段已经取得每个 nozomi 词的头部, 直接作为指纹
+        nozomi = {plan.subpath: (plan.estimate, plan.first_id) for plan in plans if plan.subpath is not None}
+        version = self.version if any(plan.subpath is None for plan in plans) else None
+        self.put(key, ids, version, nozomi)
 
+    def invalidate(self, version: str):
+        """切换到新版本, 丢弃依赖旧版本 B 树的条目"""
+        if version == self.version:
+            return
+        self.version = version
+        for key in [k for k, entry in self._entries.items() if entry.version is not None and entry.version != version]:
+            self._drop(key)
+        if self._conn is not None:
+            self._conn.execute('DELETE FROM search_cache WHERE version IS NOT NULL AND version != ?', (version,))
+            self._conn.commit()
 
-async def cliDownload(comic_list: list[int]):
-    await refreshVersion()
-    for comic_id in comic_list:
-        comic = await getComic(comic_id)
-        with open(f'{comic_id}.zip', 'wb') as f:
-            await downloadComic(comic, f, max_threads=5)
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
 
 
-async def cliSearch(search_string: str):
-    print(await searchIDs(search_string))
+search_cache = SearchCache()
+
+
+def setSearchCache(max_ids: int = 16_000_000, nozomi_max_age: float = 600, path: Optional[str | Path] = None):
+    """重新配置搜索缓存, max_ids 为 0 时关闭, path 为 None 时仅使用内存"""
+    global search_cache
+    search_cache.close()
+    search_cache = SearchCache(max_ids, nozomi_max_age, path)
+    search_cache.invalidate(index_versions[galleries_index_dir])
+
+
+# ================= 分页 / 流式搜索 =================
+
+class NozomiCursor:
+    """
+    按页向后读取 nozomi 的游标 (nozomi 按新到旧排列)
+    已读取部分中的最小 ID 记为 low: 大于等于 low 的 ID 在该文件中是否存在已经确定
+    读取失败时抛出 ConnectionError, 不会被当作文件末尾
+    """
+
+    def __init__(self, client: httpx.AsyncClient, subpath: str, page_ids: int = 1024, max_page_ids: int = 1 << 18):
+        self.client = client
+        self.subpath = subpath
+        self.url = f"{subpath}.nozomi"
+        self.page_ids = page_ids
+        self.max_page_ids = max_page_ids
+        self.pos = 0
+        self.exhausted = False
+        self.low: Optional[int] = None
+        # 已读取但尚未结算的 ID, 升序
+        self.buffer = empty_ids()
+
+    async def advance(self):
+        raw = await get_bytes(self.client, self.url, self.pos * 4, self.page_ids * 4)
+        raw = raw[:len(raw) - len(raw) % 4]
+        if not raw:
+            # 空响应可能是已到文件末尾 (416/404), 也可能是重试耗尽, 由头部请求中的文件长度区分
+            head = await get_nozomi_head(self.client, self.subpath)
+            if head is None or head[0] // 4 > self.pos:
+                raise ConnectionError(f'{self.url} 读取失败: 第 {self.pos} 个 ID 起')
+        if len(raw) < self.page_ids * 4:
+            self.exhausted = True
+        if raw:
+            page = decode_ids(raw)
+            self.pos += len(raw) // 4
+            self.buffer = np.concatenate((page, self.buffer))
+            self.low = int(page[0])
+        if self.exhausted:
+            self.low = -1
+        # 页逐步加倍, 首页只需几 KB, 之后减少往返次数
+        self.page_ids = min(self.page_ids * 2, self.max_page_ids)
+
+    def settle(self, threshold: int) -> np.ndarray:
+        """取出 (并移出缓冲区) 所有大于等于 threshold 的 ID"""
+        split = int(np.searchsorted(self.buffer, threshold))
+        settled, self.buffer = self.buffer[split:], self.buffer[:split]
+        return settled
+
+
+async def iterSearchIDs(query: str, page_ids: int = 1024,
+                        session: Optional[HitomiSession] = None) -> AsyncIterator[int]:
+    """
+    流式搜索, 按新到旧逐个产出 ID
+    AND / NOT 中的 nozomi 词用 Range 请求分页读取, 一个 ID 在所有文件中的归属都确定后立即产出;
+    B 树词与 OR 组仍一次性取回, 作为过滤集合. 没有可流式读取的 AND 词时退化为 searchIDs
+    """
+    positive_terms, or_groups, negative_terms = parse_query(query)
+    if not positive_terms and not or_groups:
+        return
+    async with useSession(session, timeout=5) as session:
+        client = session.ltn
+        stream_terms = [t for t in positive_terms if nozomi_subpath(t.replace('_', ' '))]
+        if not stream_terms:
+            for gid in await searchIDs(query, session=session):
+                yield gid
+            return
+        filter_terms = [t for t in positive_terms if t not in stream_terms]
+        not_stream_terms = [t for t in negative_terms if nozomi_subpath(t.replace('_', ' '))]
+        not_set_terms = [t for t in negative_terms if t not in not_stream_terms]
+        # 1. 一次性取回过滤集合
+        group_terms = [t for g in or_groups for t in g]
+        batch = await search_terms(client, filter_terms + group_terms + not_set_terms)
+        filter_results = batch[:len(filter_terms)]
+        pos = len(filter_terms)
+        for g in or_groups:
+            filter_results.append(union_ids(batch[pos:pos + len(g)]))
+            pos += len(g)
+        not_sets = batch[pos:]
+        id_filter: Optional[np.ndarray] = None
+        for res in filter_results:
+            id_filter = res if id_filter is None else intersect_ids(id_filter, res)
+        if id_filter is not None and not id_filter.size:
+            return
+        # 2. 分页推进 nozomi 游标, 每轮只推进卡住进度的游标
+        and_cursors = [NozomiCursor(client, nozomi_subpath(t.replace('_', ' ')), page_ids) for t in stream_terms]
+        not_cursors = [NozomiCursor(client, nozomi_subpath(t.replace('_', ' ')), page_ids) for t in not_stream_terms]
+        cursors = and_cursors + not_cursors
+        await asyncio.gather(*[c.advance() for c in cursors])
+        while True:
+            threshold = max(c.low for c in cursors)
+            confirmed: Optional[np.ndarray] = None
+            for c in and_cursors:
+                settled = c.settle(threshold)
+                confirmed = settled if confirmed is None else intersect_ids(confirmed, settled)
+            if id_filter is not None:
+                confirmed = intersect_ids(confirmed, id_filter)
+            for c in not_cursors:
+                confirmed = difference_ids(confirmed, c.settle(threshold))
+            for not_ids in not_sets:
+                confirmed = difference_ids(confirmed, not_ids)
+            for gid in confirmed[::-1].tolist():
+                yield gid
+            # 任一 AND 文件已读完且全部结算, 或过滤集合中已没有更旧的 ID, 就不会再有结果
+            if any(c.exhausted and not c.buffer.size for c in and_cursors):
+                return
+            if id_filter is not None and threshold <= int(id_filter[0]):
+                return
+            await asyncio.gather(*[c.advance() for c in cursors if c.low == threshold and not c.exhausted])
+
+
+async def searchIDsPage(query: str, offset: int = 0, limit: int = 25,
+                        session: Optional[HitomiSession] = None) -> list[int]:
+    """分页搜索, 只读取得到第 offset 到 offset + limit 个结果所需的 nozomi 片段"""
+    result = []
+    async with contextlib.aclosing(iterSearchIDs(query, session=session)) as id_stream:
+        async for gid in id_stream:
+            if offset > 0:
+                offset -= 1
+                continue
+            result.append(gid)
+            if len(result) >= limit:
+                break
+    return result
+
+
+# ================= 增量同步 (watch) =================
+
+# watch 首次读取 nozomi 头部的 ID 数, 之后每轮翻倍; 没有新画廊时每个词只需读取这么多
+WATCH_HEAD_IDS = 64
+
+
+async def get_nozomi_newer(client: httpx.AsyncClient, subpath: str, high_water: int) -> np.ndarray:
+    """只读取 nozomi 头部, 返回比 high_water 更新的 ID (升序); 文件不存在视为空, 读取失败抛出 ConnectionError"""
+    cursor = NozomiCursor(client, subpath, WATCH_HEAD_IDS)
+    await cursor.advance()
+    while not cursor.exhausted and cursor.low > high_water:
+        await cursor.advance()
+    return cursor.settle(high_water + 1)
+
+
+async def watch_query(client: httpx.AsyncClient, query: str,
+                      high_water: Optional[int]) -> tuple[np.ndarray, Optional[int]]:
+    """
+    查询自 high_water 以来的新结果, 返回 (升序的新 ID, 新的 high_water)
+    新画廊的 ID 总是大于已有画廊, 而 nozomi 按新到旧排列, 所以判断一个新 ID 是否属于某个 nozomi 词
+    只需读取该文件头部大于 high_water 的部分; 全部由 nozomi 词组成的 AND 单元 / OR 组由此得到候选集,
+    B 树词与混合的 OR 组再按候选集过滤 (fetch_term).
+    high_water 为 None (建立基线) 或没有可读头部的单元时, 执行完整查询后截取.
+    任何索引读取失败都抛出 ConnectionError, 而不是把缺失的结果当作没有新画廊
+    """
+    positive_terms, or_groups, negative_terms = parse_query(query)
+    units = [[t] for t in positive_terms] + or_groups
+    if not units:
+        return empty_ids(), high_water
+
+    def is_nozomi(term: str) -> bool:
+        return nozomi_subpath(term.replace('_', ' ')) is not None
+
+    head_units = [unit for unit in units if all(is_nozomi(t) for t in unit)]
+    if high_water is None or not head_units:
+        # 读取失败时 execute_query 直接抛出, 不会得到残缺结果算出的 high_water
+        ids, plans = await execute_query(client, positive_terms, or_groups, negative_terms)
+        newest = [int(ids[-1])] if ids.size else []
+        newest += [plan.first_id for plan in plans if plan.first_id is not None]
+        if high_water is not None:
+            ids = ids[ids > high_water]
+        return ids, max(newest + [high_water or 0])
+    # 1. 并发读取所有 nozomi 词 (含排除词) 的头部
+    head_terms = list(dict.fromkeys([t for unit in head_units for t in unit] +
+                                    [t for t in negative_terms if is_nozomi(t)]))
+    heads = dict(zip(head_terms, await asyncio.gather(
+        *[get_nozomi_newer(client, nozomi_subpath(t.replace('_', ' ')), high_water) for t in head_terms])))
+    # 之后出现的画廊只会比现在读到的所有 ID 更新
+    high_water = max([int(ids[-1]) for ids in heads.values() if ids.size] + [high_water])
+    candidates: Optional[np.ndarray] = None
+    for unit in head_units:
+        unit_ids = union_ids([heads[t] for t in unit])
+        candidates = unit_ids if candidates is None else intersect_ids(candidates, unit_ids)
+    if not candidates.size:
+        return candidates, high_water
+    # 2. 其余单元与排除词按候选集过滤
+    rest_units = [unit for unit in units if unit not in head_units]
+    rest_negative = [t for t in negative_terms if not is_nozomi(t)]
+    rest_terms = list(dict.fromkeys([t for unit in rest_units for t in unit] + rest_negative))
+    plans = dict(zip(rest_terms, await plan_terms(client, rest_terms)))
+    check_plans(list(plans.values()))
+    await prefetch_data(client, list(plans.values()))
+    check_plans(list(plans.values()))
+    for unit in rest_units:
+        results = await asyncio.gather(*[fetch_term(client, plans[t], candidates) for t in unit])
+        check_plans([plans[t] for t in unit])
+        candidates = intersect_ids(candidates, union_ids(list(results)))
+        if not candidates.size:
+            return candidates, high_water
+    for t in negative_terms:
+        not_ids = heads[t] if t in heads else await fetch_term(client, plans[t], candidates)
+        candidates = difference_ids(candidates, not_ids)
+    check_plans(list(plans.values()))
+    return candidates, high_water
+
+
+class QueryWatcher:
+    """
+    已保存查询的增量同步
+    每个查询在 SQLite 中记录一个 high_water (已处理过的最新画廊 ID), 每次 poll 只读取各 nozomi 词的头部,
+    返回比它更新的结果; 首次 poll 执行完整查询, 只建立基线不返回结果.
+    新结果与推进后的 high_water 在同一事务中记入 pending 表, 下载成功后由 done 移除;
+    下载失败或进程中途退出时, 这些 ID 会在下次 poll 时再次返回
+    注意: 晚于 high_water 之后才被补上 tag 的旧画廊不会被发现
+    """
+
+    def __init__(self, path: str | Path = 'watch.sqlite3'):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS watches ('
+                           'query TEXT PRIMARY KEY, high_water INTEGER, checked_at REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pending ('
+                           'query TEXT NOT NULL, gallery_id INTEGER NOT NULL, PRIMARY KEY (query, gallery_id))')
+        self._conn.commit()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return ' '.join(query.lower().split())
+
+    def add(self, query: str):
+        self._conn.execute('INSERT OR IGNORE INTO watches (query) VALUES (?)', (self.normalize(query),))
+        self._conn.commit()
+
+    def remove(self, query: str):
+        self._conn.execute('DELETE FROM watches WHERE query = ?', (self.normalize(query),))
+        self._conn.execute('DELETE FROM pending WHERE query = ?', (self.normalize(query),))
+        self._conn.commit()
+
+    def queries(self) -> dict[str, Optional[int]]:
+        return dict(self._conn.execute('SELECT query, high_water FROM watches ORDER BY query'))
+
+    async def poll(self, query: str, session: Optional[HitomiSession] = None) -> list[int]:
+        """返回该查询的新画廊 ID 与此前未完成的 ID (按新到旧), 并推进 high_water"""
+        query = self.normalize(query)
+        row = self._conn.execute('SELECT high_water FROM watches WHERE query = ?', (query,)).fetchone()
+        high_water = row[0] if row else None
+        async with useSession(session, timeout=5) as session:
+            ids, new_high_water = await watch_query(session.ltn, query, high_water)
+        if high_water is None:
+            logger.info(f'watch {query}: 建立基线, high_water={new_high_water}')
+            new_ids = []
+        else:
+            new_ids = ids[::-1].tolist()
+        high_water = new_high_water
+        self._conn.executemany('INSERT OR IGNORE INTO pending (query, gallery_id) VALUES (?, ?)',
+                               [(query, gid) for gid in new_ids])
+        self._conn.execute('INSERT OR REPLACE INTO watches (query, high_water, checked_at) VALUES (?, ?, ?)',
+                           (query, high_water, time.time()))
+        self._conn.commit()
+        return [row[0] for row in self._conn.execute(
+            'SELECT gallery_id FROM pending WHERE query = ? ORDER BY gallery_id DESC', (query,))]
+
+    def done(self, gallery_ids: list[int]):
+        """标记画廊已下载完成, 从所有查询的 pending 中移除"""
+        self._conn.executemany('DELETE FROM pending WHERE gallery_id = ?', [(gid,) for gid in gallery_ids])
+        self._conn.commit()
+
+    async def pollAll(self, session: Optional[HitomiSession] = None) -> dict[str, list[int]]:
+        """并发 poll 所有已保存的查询, 相同词的头部读取只发一次; 失败的查询保持原状, 不出现在结果中"""
+        queries = list(self.queries())
+        async with useSession(session, timeout=5) as session:
+            results = await asyncio.gather(*[self.poll(query, session) for query in queries],
+                                           return_exceptions=True)
+        found = {}
+        for query, result in zip(queries, results):
+            if isinstance(result, Exception):
+                logger.error(f'watch {query} 查询失败: {type(result)}:{result}')
+            else:
+                found[query] = result
+        return found
+
+    def close(self):
+        self._conn.close()
+
+
+# ================= 常驻服务 =================
+
+class DownloadJob(BaseModel):
+    job_id: int
+    gallery_id: int
+    # queued / running / done / failed
+    status: str = 'queued'
+    pages_done: int = 0
+    pages_total: int = 0
+    bytes: int = 0
+    file: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class ServiceError(Exception):
+    """携带 HTTP 状态码的接口错误"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class HitomiService:
+    """
+    常驻服务: 会话连接池、gg.js、索引版本与各级缓存在请求之间保持热状态
+    通过本地 HTTP/JSON 接口提供搜索、元数据与下载; 下载任务进入有界队列,
+    由 jobs 个 worker 执行, 所有页面请求共享 concurrency 的并发预算
+
+    GET  /status                           服务状态
+    GET  /search?q=...&offset=0&limit=100  搜索, 返回按新到旧排列的 ID
+    GET  /comic/{id}                       画廊元数据
+    POST /download  {"ids": [...]}         加入下载队列, 返回任务
+    GET  /jobs, /jobs/{job_id}             任务状态与进度
+    GET  /metrics                          Prometheus 文本格式的指标 (需 setMetrics 开启)
+    """
+
+    def __init__(self, output_dir: str | Path = '.', jobs: int = 2, concurrency: int = 20,
+                 host_limit: Optional[int] = None, max_queue: int = 1000,
+                 resume_dir: Optional[str | Path] = None, version_ttl: float = 300, max_finished: int = 1000):
+        self.output_dir = Path(output_dir)
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.resume_dir = resume_dir
+        self.version_ttl = version_ttl
+        self.max_finished = max_finished
+        self.limiter = PageLimiter(concurrency, host_limit)
+        self.queue: asyncio.Queue[DownloadJob] = asyncio.Queue(maxsize=max_queue)
+        self.download_jobs: OrderedDict[int, DownloadJob] = OrderedDict()
+        self.session: Optional[HitomiSession] = None
+        self.started_at = time.time()
+        self._next_job_id = 1
+        self._version_checked = 0.0
+        self._workers: list[asyncio.Task] = []
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.session = HitomiSession(image_limits=httpx.Limits(max_keepalive_connections=self.concurrency,
+                                                               max_connections=self.concurrency))
+        await self.ensureVersion()
+        self._workers = [asyncio.ensure_future(self.worker()) for _ in range(self.jobs)]
+        self._server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'服务已启动: http://{host}:{self._server.sockets[0].getsockname()[1]}')
+
+    async def run(self, host: str = '127.0.0.1', port: int = 8765):
+        """启动并一直运行, 直到被取消"""
+        await self.start(host, port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self.session is not None:
+            await self.session.aclose()
+
+    async def ensureVersion(self):
+        """距离上次确认超过 version_ttl 时刷新索引版本, 并发的调用只刷新一次"""
+        if time.monotonic() - self._version_checked < self.version_ttl:
+            return
+        await inflight.do(('refreshVersion', id(self)), lambda: refreshVersion(self.session))
+        self._version_checked = time.monotonic()
+
+    # ---------- 下载队列 ----------
+
+    def enqueue(self, gallery_ids: list[int]) -> list[DownloadJob]:
+        if len(gallery_ids) > self.queue.maxsize - self.queue.qsize():
+            raise ServiceError(503, f'下载队列已满 ({self.queue.qsize()}/{self.queue.maxsize})')
+        new_jobs = []
+        for gallery_id in gallery_ids:
+            job = DownloadJob(job_id=self._next_job_id, gallery_id=gallery_id)
+            self._next_job_id += 1
+            self.download_jobs[job.job_id] = job
+            self.queue.put_nowait(job)
+            new_jobs.append(job)
+        self._trimJobs()
+        return new_jobs
+
+    def _trimJobs(self):
+        """只保留最近 max_finished 个已结束的任务"""
+        finished = [job_id for job_id, job in self.download_jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.download_jobs[job_id]
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.runJob(job)
+            finally:
+                self.queue.task_done()
+
+    async def runJob(self, job: DownloadJob):
+        job.status = 'running'
+        job.started_at = time.time()
+        archive_path = self.output_dir / f'{job.gallery_id}.zip'
+
+        # noinspection PyUnusedLocal
+        async def page_done(dl_url: str):
+            job.pages_done += 1
+
+        try:
+            comic = await getComic(job.gallery_id, self.session)
+            if comic is None:
+                raise ServiceError(404, f'画廊 {job.gallery_id} 不存在')
+            job.pages_total = len(comic.files)
+            with open(archive_path, 'wb') as f:
+                if not await downloadComic(comic, f, phase_callback=page_done, session=self.session,
+                                           resume_dir=self.resume_dir, limiter=self.limiter):
+                    raise ServiceError(404, f'画廊 {job.gallery_id} 没有页面')
+            job.bytes = archive_path.stat().st_size
+            job.file = str(archive_path)
+            job.status = 'done'
+        except Exception as e:
+            logger.error(f'{job.gallery_id} 下载失败: {type(e)}:{e}')
+            archive_path.unlink(missing_ok=True)
+            job.error = f'{type(e).__name__}: {e}'
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+        self._trimJobs()
+
+    # ---------- HTTP 接口 ----------
+
+    def status(self) -> dict:
+        counts: dict[str, int] = {}
+        for job in self.download_jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'uptime': time.time() - self.started_at,
+            'index_versions': index_versions,
+            'queue': self.queue.qsize(),
+            'jobs': counts,
+            'search_cache': {'entries': len(search_cache._entries), 'ids': search_cache._size},
+            'btree_nodes': len(btree_cache._nodes),
+        }
+
+    async def route(self, method: str, path: str, params: dict[str, str], body: bytes) -> tuple[int, Any]:
+        parts = [part for part in path.split('/') if part]
+        if method == 'GET' and parts == ['status']:
+            return 200, self.status()
+        if method == 'GET' and parts == ['metrics']:
+            return 200, metrics.prometheus()
+        if method == 'GET' and parts == ['search']:
+            query = params.get('q', '').strip()
+            if not query:
+                raise ServiceError(400, '缺少参数 q')
+            offset, limit = int_param(params, 'offset', 0), int_param(params, 'limit', 100)
+            await self.ensureVersion()
+            ids = await searchIDs(query, session=self.session)
+            return 200, {'query': query, 'total': len(ids), 'ids': ids[offset:offset + limit]}
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'comic':
+            comic = await getComic(int_param({'id': parts[1]}, 'id'), self.session)
+            if comic is None:
+                raise ServiceError(404, f'画廊 {parts[1]} 不存在')
+            return 200, comic
+        if method == 'POST' and parts == ['download']:
+            try:
+                gallery_ids = [int(gallery_id) for gallery_id in json.loads(body or b'{}')['ids']]
+            except (ValueError, TypeError, KeyError):
+                raise ServiceError(400, '请求体应为 {"ids": [...]}')
+            return 202, {'jobs': [job.model_dump() for job in self.enqueue(gallery_ids)]}
+        if method == 'GET' and parts == ['jobs']:
+            return 200, {'jobs': [job.model_dump() for job in self.download_jobs.values()]}
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+            job = self.download_jobs.get(int_param({'job_id': parts[1]}, 'job_id'))
+            if job is None:
+                raise ServiceError(404, f'任务 {parts[1]} 不存在')
+            return 200, job
+        raise ServiceError(404, f'未知接口: {method} {path}')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """极简的 HTTP/1.1 处理: 每个连接一个请求, 请求与响应均为 JSON (/metrics 除外)"""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) != 3:
+                return
+            method, target, _ = request_line
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                status, payload = await self.route(method.upper(), url.path, params, body)
+            except ServiceError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:
+                logger.exception(f'{method} {target} 处理失败')
+                status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+            content_type = 'application/json'
+            if isinstance(payload, str):
+                data = payload.encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif isinstance(payload, BaseModel):
+                data = payload.model_dump_json().encode('utf-8')
+            else:
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            writer.write(f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                         f'Content-Type: {content_type}; charset=utf-8\r\n'
+                         f'Content-Length: {len(data)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.debug(f'连接异常: {type(e)}:{e}')
+        finally:
+            writer.close()
+
+
+def int_param(params: dict[str, str], name: str, default: Optional[int] = None) -> int:
+    value = params.get(name)
+    if value is None and default is not None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f'参数 {name} 应为整数')
+
+
+async def cliDownload(comic_list: list[int], resume_dir: Optional[str] = None,
+                      jobs: int = 1, concurrency: int = 5, host_limit: Optional[int] = None,
+                      output_dir: str = '.'):
+    async with HitomiSession() as session:
+        await refreshVersion(session)
+        report = await batchDownload(comic_list, output_dir, jobs=jobs, concurrency=concurrency, host_limit=host_limit,
+                                     session=session, resume_dir=resume_dir)
+    logger.info(report.summary())
+
+
+async def cliServe(address: str, output_dir: str = '.', resume_dir: Optional[str] = None,
+                   jobs: int = 2, concurrency: int = 20, host_limit: Optional[int] = None):
+    host, _, port = address.rpartition(':')
+    service = HitomiService(output_dir, jobs=jobs, concurrency=concurrency, host_limit=host_limit,
+                            resume_dir=resume_dir)
+    await service.run(host or '127.0.0.1', int(port))
+
+
+async def cliWatch(queries: list[str], watch_db: str, interval: float = 0, output_dir: str = '.',
+                   resume_dir: Optional[str] = None, jobs: int = 1, concurrency: int = 5,
+                   host_limit: Optional[int] = None):
+    watcher = QueryWatcher(watch_db)
+    for query in queries:
+        watcher.add(query)
+    try:
+        async with HitomiSession() as session:
+            while True:
+                await refreshVersion(session)
+                found = await watcher.pollAll(session)
+                for query, ids in found.items():
+                    if ids:
+                        logger.info(f'watch {query}: {len(ids)} 个新画廊')
+                new_ids = list(dict.fromkeys(gid for ids in found.values() for gid in ids))
+                if new_ids:
+                    report = await batchDownload(new_ids, output_dir, jobs=jobs, concurrency=concurrency,
+                                                 host_limit=host_limit, session=session, resume_dir=resume_dir)
+                    logger.info(report.summary())
+                    # 失败的画廊留在 pending 中, 下一轮重试
+                    watcher.done([gid for gid in new_ids if gid not in report.failed])
+                if interval <= 0:
+                    break
+                await asyncio.sleep(interval)
+    finally:
+        watcher.close()
+
+
+async def cliSearch(search_string: str, mirror_dir: Optional[str] = None):
+    async with HitomiSession() as session:
+        await refreshVersion(session)
+        if mirror_dir is not None:
+            setIndexMirror(mirror_dir)
+            positive_terms, or_groups, negative_terms = parse_query(search_string)
+            terms = positive_terms + [t for g in or_groups for t in g] + negative_terms
+            subpaths = [nozomi_subpath(t.replace('_', ' ')) for t in terms]
+            await index_mirror.sync(session, [subpath for subpath in subpaths if subpath])
+        print(await searchIDs(search_string, session=session))
 
 
 if __name__ == '__main__':
@@ -671,12 +3313,99 @@ if __name__ == '__main__':
                            dest='search_str',
                            type=str,
                            help='搜索comic')
+    arg_group.add_argument('--serve',
+                           dest='serve_address',
+                           nargs='?',
+                           const='127.0.0.1:8765',
+                           metavar='HOST:PORT',
+                           help='以常驻服务运行, 提供本地 HTTP/JSON 接口 (默认 127.0.0.1:8765)')
+    arg_group.add_argument('-w', '--watch',
+                           dest='watch_queries',
+                           nargs='*',
+                           metavar='QUERY',
+                           help='增量同步: 保存给出的查询, 检查所有已保存查询的新画廊并下载')
+    parser.add_argument('-o', '--output-dir',
+                        dest='output_dir',
+                        type=str,
+                        default='.',
+                        help='下载保存目录')
+    parser.add_argument('-r', '--resume-dir',
+                        dest='resume_dir',
+                        type=str,
+                        help='断点续传暂存目录, 下载中断后重新运行只补齐缺失的页')
+    parser.add_argument('--page-store',
+                        dest='page_store',
+                        type=str,
+                        metavar='DIR',
+                        help='按页面哈希寻址的本地图片库目录, 已下载过的页不再重复下载')
+    parser.add_argument('--page-store-size',
+                        dest='page_store_size',
+                        type=float,
+                        default=10,
+                        metavar='GiB',
+                        help='图片库容量上限, 超出时淘汰最久未使用的页 (默认 10 GiB)')
+    parser.add_argument('-m', '--mirror',
+                        dest='mirror_dir',
+                        type=str,
+                        help='本地索引镜像目录, 搜索前同步索引与用到的 nozomi, 之后在本地完成搜索')
+    parser.add_argument('--watch-db',
+                        dest='watch_db',
+                        type=str,
+                        default='watch.sqlite3',
+                        help='watch 保存查询及其进度的数据库')
+    parser.add_argument('--interval',
+                        dest='interval',
+                        type=float,
+                        default=0,
+                        help='watch 的轮询间隔 (秒), 默认只检查一次')
+    parser.add_argument('-j', '--jobs',
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        help='同时下载的画廊数')
+    parser.add_argument('-c', '--concurrency',
+                        dest='concurrency',
+                        type=int,
+                        default=5,
+                        help='所有画廊共享的页面并发数')
+    parser.add_argument('--metrics',
+                        dest='metrics_file',
+                        nargs='?',
+                        const='-',
+                        metavar='FILE',
+                        help='采集请求与各阶段的指标, 结束时将 JSON 汇总写入 FILE (默认输出到标准输出); 服务模式下通过 /metrics 导出')
+    parser.add_argument('--host-limit',
+                        dest='host_limit',
+                        type=int,
+                        help='每个图片域名的并发上限, 默认与 --concurrency 相同')
     args = parser.parse_args()
     if args.proxy:
         logger.info(f'正在使用代理: {args.proxy}')
         setProxy(args.proxy)
-    asyncio.run(refreshVersion())
+    if args.metrics_file:
+        setMetrics(True)
+    if args.page_store:
+        setPageStore(args.page_store, int(args.page_store_size * 1024 ** 3))
     if args.comic_ids:
-        asyncio.run(cliDownload(args.comic_ids))
+        asyncio.run(cliDownload(args.comic_ids, args.resume_dir, args.jobs, args.concurrency, args.host_limit,
+                                args.output_dir))
+    elif args.serve_address:
+        try:
+            asyncio.run(cliServe(args.serve_address, args.output_dir, args.resume_dir, args.jobs,
+                                 args.concurrency, args.host_limit))
+        except KeyboardInterrupt:
+            logger.info('服务已停止')
+    elif args.watch_queries is not None:
+        try:
+            asyncio.run(cliWatch(args.watch_queries, args.watch_db, args.interval, args.output_dir, args.resume_dir,
+                                 args.jobs, args.concurrency, args.host_limit))
+        except KeyboardInterrupt:
+            logger.info('watch 已停止')
     else:
-        asyncio.run(cliSearch(args.search_str))
+        asyncio.run(cliSearch(args.search_str, args.mirror_dir))
+    if args.metrics_file and not args.serve_address:
+        summary = json.dumps(metrics.summary(), ensure_ascii=False, indent=2)
+        if args.metrics_file == '-':
+            print(summary)
+        else:
+            Path(args.metrics_file).write_text(summary, encoding='utf-8')
@@ -1,7 +1,9 @@
+import atexit
 import logging
+import queue
 import sys
 import os
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import colorlog
 from pathlib import Path
 from typing import Callable
@@ -14,20 +16,20 @@ ERROR_LEVEL = logging.ERROR
 CRITICAL_LEVEL = logging.CRITICAL
 
 
-def getLogger(module_name: str, log_dir=Path("logs"), debug: bool = False)\
+def getLogger(module_name: str, log_dir=Path("logs"), debug: bool = False,
+              non_blocking: bool = False, caller_info: bool = True)\
         -> tuple[logging.Logger, Callable[[int], None], Callable[[int], None]]:
     """
     获取配置好的 Logger 对象
     :param module_name: 模块名称
     :param log_dir: 日志目录
     :param debug: 是否开启控制台调试模式 (True: 显示DEBUG级别, False: 显示INFO级别)
+    :param non_blocking: 调用方只做消息插值 (QueueHandler.prepare) 后放入队列, Handler 的格式化、控制台输出与文件轮转都在后台线程中完成
+    :param caller_info: 是否记录文件名/函数名/行号, 关闭后不再为每条日志回溯调用栈
     :return: logging.Logger
     """
     logger = logging.getLogger(module_name)
     logger.propagate = False
-    # 1. 关键修改：将总记录器的级别设置为 DEBUG
-    # 这样所有级别的日志才能通过“总闸”，流向后面的 Handler 进行筛选
-    logger.setLevel(logging.DEBUG)
 
     def preventSB(level: int):
         raise NotImplementedError(f"Logger '{module_name}' 已经被初始化过了，别乱改 Level！")
@@ -38,8 +40,12 @@ def getLogger(module_name: str, log_dir=Path("logs"), debug: bool = False)\
     base_fmt = (
         "[%(asctime)s] %(levelname)-8s "
         "[%(threadName)s|%(processName)s] %(name)s "
-        "%(filename)s:%(funcName)s:%(lineno)s | %(message)s"
+        + ("%(filename)s:%(funcName)s:%(lineno)s " if caller_info else "")
+        + "| %(message)s"
     )
+    if not caller_info:
+        # 只对这个 logger 跳过 findCaller 的栈回溯
+        logger.findCaller = lambda stack_info=False, stacklevel=1: ("(unknown file)", 0, "(unknown function)", None)
     date_fmt = "%H:%M:%S"
     # ---------------------------------------------------------------
     # 2. 配置控制台 Handler (动态控制)
@@ -61,7 +67,6 @@ def getLogger(module_name: str, log_dir=Path("logs"), debug: bool = False)\
             'CRITICAL': 'red,bg_white'
         }
     ))
-    logger.addHandler(console_handler)
     # ---------------------------------------------------------------
     # 3. 配置文件 Handler (只记录 WARNING)
     # ---------------------------------------------------------------
@@ -74,14 +79,34 @@ def getLogger(module_name: str, log_dir=Path("logs"), debug: bool = False)\
     # 关键修改：强制文件 Handler 只接收 WARNING 及以上级别
     file_handler.setLevel(logging.WARNING)
     file_handler.setFormatter(logging.Formatter(base_fmt, datefmt="%Y-%m-%d " + date_fmt))
-    logger.addHandler(file_handler)
+    # ---------------------------------------------------------------
+    # 4. 挂载 Handler: 直接写出, 或经由队列交给后台线程
+    # ---------------------------------------------------------------
+    if non_blocking:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+        listener.start()
+        # 退出前把队列中剩余的日志写完
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
+    else:
+        logger.addHandler(console_handler)
+        logger.addHandler(file_handler)
+
+    def syncLevel():
+        # 总闸取两个 Handler 中较低的级别: 没有 Handler 需要的日志在调用处就被丢弃,
+        # logger.isEnabledFor 也因此可以用来跳过昂贵的日志参数构造
+        logger.setLevel(min(console_handler.level, file_handler.level))
 
     def setConsoleLevel(level: int):
         console_handler.setLevel(level)
+        syncLevel()
 
     def setFileLevel(level: int):
         file_handler.setLevel(level)
+        syncLevel()
 
+    syncLevel()
     return logger, setConsoleLevel, setFileLevel
 
 